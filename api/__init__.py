@@ -19,19 +19,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from flask import request,Response
-import simplejson
+from itertools import chain
 import uuid
 
 from dict2xml import *
+from dict2json import dict2json_chunks
 
 from web import app
 from managers.user import UserManager
 
-
-# To encode the custom UUID type from database
-class SupysonicEncoder(simplejson.JSONEncoder):
-    def default(self, o):
-        return unicode(o)
+def api_version():
+    # Clients only send tokens to servers announcing 1.13.0, the version that introduced them
+    return "1.13.0" if UserManager.token_auth_enabled() else "1.8.0"
 
 @app.before_request
 def set_formatter():
@@ -71,11 +70,16 @@ def authorize():
             request.user = user
             return
 
-    (username, password) = map(request.args.get, [ 'u', 'p' ])
-    if not username or not password:
+    (username, password, token, salt) = map(request.args.get, [ 'u', 'p', 't', 's' ])
+    if username and token and salt:
+        status, user = UserManager.try_token_auth(username, token, salt)
+        if status == UserManager.TOKEN_UNSUPPORTED:
+            return request.error_formatter(41, UserManager.error_str(status)), 401
+    elif not username or not password:
         return error
+    else:
+        status, user = UserManager.try_auth(username, password)
 
-    status, user = UserManager.try_auth(username, password)
     if status != UserManager.SUCCESS:
         return error
 
@@ -103,44 +107,43 @@ def not_found(error):
 class ResponseHelper:
 
     @staticmethod
-    def responsize_json(ret, error = False, version = "1.8.0"):
-        def check_lists(d):
-            for key, value in d.items():
-                if isinstance(value, dict):
-                    d[key] = check_lists(value)
-                elif isinstance(value, list):
-                    if len(value) == 0:
-                        del d[key]
-                    else:
-                        d[key] = [ check_lists(item) if isinstance(item, dict) else item for item in value ]
-            return d
-
-        ret = check_lists(ret)
+    def json_chunks(ret, error = False, version = None):
         # add headers to response
         ret.update({
             'status': 'failed' if error else 'ok',
-            'version': version,
+            'version': version or api_version(),
             'xmlns': "http://subsonic.org/restapi"
         })
-        return simplejson.dumps({ 'subsonic-response': ret }, indent = True, encoding = 'utf-8', cls=SupysonicEncoder)
+        # Empty lists are left out while writing
+        return dict2json_chunks({ 'subsonic-response': ret })
+
+    @staticmethod
+    def responsize_json(ret, error = False, version = None):
+        return Response(ResponseHelper.json_chunks(ret, error, version), content_type = 'application/json')
 
 
     @staticmethod
-    def responsize_jsonp(ret, callback, error = False, version = "1.8.0"):
-        return "%s(%s)" % (callback, ResponseHelper.responsize_json(ret, error, version))
+    def responsize_jsonp(ret, callback, error = False, version = None):
+        # stream and getCoverArt may be called without one, their errors are then plain JSON
+        if not callback:
+            return ResponseHelper.responsize_json(ret, error, version)
+
+        output = ResponseHelper.json_chunks(ret, error, version)
+        return Response(chain([ callback + '(' ], output, [ ')' ]), content_type = 'application/json')
 
 
     @staticmethod
-    def responsize_xml(ret, error = False, version = "1.8.0"):
+    def responsize_xml(ret, error = False, version = None):
         ret.update({
             'status': 'failed' if error else 'ok',
-            'version': version,
+            'version': version or api_version(),
             'xmlns': "http://subsonic.org/restapi"
         })
 
-        output = dict2xml(ret, "subsonic-response")
+        # Written out as it is sent rather than built as a whole, large lists make for large documents
+        output = dict2xml_chunks(ret, "subsonic-response")
 
-        return Response(u'<?xml version="1.0" encoding="UTF-8"?>' + output, content_type='text/xml; charset=utf-8')
+        return Response(chain([ u'<?xml version="1.0" encoding="UTF-8"?>' ], output), content_type='text/xml; charset=utf-8')
 
 
 
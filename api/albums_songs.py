@@ -62,7 +62,7 @@ def rand_songs():
 
 	return request.formatter({
 		'randomSongs': {
-			'song': [ t.as_subsonic_child(request.user) for t in tracks ]
+			'song': Track.as_subsonic_children(tracks, request.user)
 		}
 	})
 
@@ -89,7 +89,7 @@ def album_list():
 
 		return request.formatter({
 			'albumList': {
-				'album': [ a.as_subsonic_child(request.user) for a in albums ]
+				'album': Folder.as_subsonic_children(albums, request.user)
 			}
 		})
 	elif ltype == 'newest':
@@ -103,18 +103,18 @@ def album_list():
 	elif ltype == 'starred':
 		query = query.join(StarredFolder).join(User).filter(User.name == request.username)
 	elif ltype == 'alphabeticalByName':
-		query = query.order_by(Folder.name)
+		query = query.order_by(Folder.name_key)
 	elif ltype == 'alphabeticalByArtist':
 		# this is a mess because who knows how your file structure is set up
 		# with the database changes it's more difficult to get the parent of a dir
 		parent = aliased(Folder)
-		query = query.join(parent, Folder.parent).order_by(parent.name).order_by(Folder.name)
+		query = query.join(parent, Folder.parent).order_by(parent.name_key).order_by(Folder.name_key)
 	else:
 		return request.error_formatter(0, 'Unknown search type')
 
 	return request.formatter({
 		'albumList': {
-			'album': [ f.as_subsonic_child(request.user) for f in query.limit(size).offset(offset) ]
+			'album': Folder.as_subsonic_children(query.limit(size).offset(offset), request.user)
 		}
 	})
 
@@ -153,9 +153,9 @@ def album_list_id3():
 	elif ltype == 'starred':
 		query = query.join(StarredAlbum).join(User).filter(User.name == request.username)
 	elif ltype == 'alphabeticalByName':
-		query = query.order_by(Album.name)
+		query = query.order_by(Album.name_key)
 	elif ltype == 'alphabeticalByArtist':
-		query = query.join(Artist).order_by(Artist.name).order_by(Album.name)
+		query = query.join(Artist).order_by(Artist.name_key).order_by(Album.name_key)
 	else:
 		return request.error_formatter(0, 'Unknown search type')
 
@@ -174,12 +174,15 @@ def now_playing():
 	else:
 		query = session.query(User).join(Track).filter(func.timediff(func.now(), User.last_play_date) < Track.duration * 2)
 
+	users = query.all()
+	entries = Track.as_subsonic_children([ u.last_play for u in users ], request.user)
+
 	return request.formatter({
 		'nowPlaying': {
 			'entry': [ dict(
-				u.last_play.as_subsonic_child(request.user).items() +
+				entry.items() +
 				{ 'username': u.name, 'minutesAgo': (now() - u.last_play_date).seconds / 60, 'playerId': 0 }.items()
-			) for u in query ]
+			) for u, entry in zip(users, entries) ]
 		}
 	})
 
@@ -188,8 +191,8 @@ def get_starred():
 	return request.formatter({
 		'starred': {
 			'artist': [ { 'id': str(sf.starred_id), 'name': sf.starred.name } for sf in session.query(StarredFolder).join(User).join(Folder).filter(User.name == request.username).filter(~ Folder.tracks.any()) ],
-			'album': [ sf.starred.as_subsonic_child(request.user) for sf in session.query(StarredFolder).join(User).join(Folder).filter(User.name == request.username).filter(Folder.tracks.any()) ],
-			'song': [ st.starred.as_subsonic_child(request.user) for st in session.query(StarredTrack).join(User).filter(User.name == request.username) ]
+			'album': Folder.as_subsonic_children(session.query(Folder).join(StarredFolder).filter(StarredFolder.user_id == request.user.id).filter(Folder.tracks.any()), request.user),
+			'song': Track.as_subsonic_children(session.query(Track).join(StarredTrack).filter(StarredTrack.user_id == request.user.id), request.user)
 		}
 	})
 
@@ -199,7 +202,7 @@ def get_starred_id3():
 		'starred2': {
 			'artist': [ sa.starred.as_subsonic_artist(request.user) for sa in session.query(StarredArtist).join(User).filter(User.name == request.username) ],
 			'album': [ sa.starred.as_subsonic_album(request.user) for sa in session.query(StarredAlbum).join(User).filter(User.name == request.username) ],
-			'song': [ st.starred.as_subsonic_child(request.user) for st in session.query(StarredTrack).join(User).filter(User.name == request.username) ]
+			'song': Track.as_subsonic_children(session.query(Track).join(StarredTrack).filter(StarredTrack.user_id == request.user.id), request.user)
 		}
 	})
 
@@ -21,12 +21,22 @@
 from flask import request
 from web import app
 
-from db import Folder, Artist, Album, Track, func, session
+from db import Folder, Artist, Album, Track, func, name_key, session
 
 from . import get_entity
 import uuid, time, string
 import os.path
 
+def index_name(key):
+	"""Index an artist goes in, by the first letter of its name key"""
+
+	index = key[0].upper() if key else '?'
+	if index in map(str, xrange(10)):
+		return '#'
+	elif index not in string.letters:
+		return '?'
+	return index
+
 @app.route('/rest/getMusicFolders.view', methods = [ 'GET', 'POST' ])
 def list_folders():
 	return request.formatter({
@@ -79,16 +89,14 @@ def list_indexes():
 
 	indexes = {}
 	for artist in artists:
-		index = artist.name[0].upper()
-		if index in map(str, xrange(10)):
-			index = '#'
-		elif index not in string.letters:
-			index = '?'
+		# Folders stored before name keys existed get theirs on the next scan
+		key = artist.name_key or name_key(artist.name)
+		index = index_name(key)
 
 		if index not in indexes:
 			indexes[index] = []
 
-		indexes[index].append(artist)
+		indexes[index].append((key, artist))
 
 	return request.formatter({
 		'indexes': {
@@ -98,9 +106,9 @@ def list_indexes():
 				'artist': [ {
 					'id': a.id,
 					'name': a.name
-				} for a in sorted(v, key = lambda a: a.name.lower()) ]
+				} for _, a in sorted(v, key = lambda x: x[0]) ]
 			} for k, v in sorted(indexes.iteritems()) ],
-			'child': [ c.as_subsonic_child(request.user) for c in sorted(childs, key = lambda t: t.sort_key()) ]
+			'child': Track.as_subsonic_children(sorted(childs, key = lambda t: t.sort_key()), request.user)
 		}
 	})
 
@@ -115,7 +123,7 @@ def show_directory():
 	directory = {
 		'id': res.id,
 		'name': res.name,
-		'child': [ f.as_subsonic_child(request.user) for f in res.get_children() ] + [ t.as_subsonic_child(request.user) for t in sorted(res.tracks, key = lambda t: t.sort_key()) ]
+		'child': Folder.as_subsonic_children(res.get_children(), request.user) + Track.as_subsonic_children(sorted(res.tracks, key = lambda t: t.sort_key()), request.user)
 	}
 	if not res.root:
 		parent = session.query(Folder).with_entities(Folder.id) \
@@ -133,14 +141,9 @@ def list_artists():
 
         # Optimized query instead of using backrefs, is there a way to speed up the backref?
 	c = session.query(Album.artist_id, func.count(Album.artist_id).label('c')).group_by(Album.artist_id).subquery(name='c')
-	for artist in session.query(Artist.name, Artist.id, c.c.c.label('albums')).join(c).order_by(Artist.name).all():
-
-		index = artist.name[0].upper() if artist.name else '?'
+	for artist in session.query(Artist.name, Artist.name_key, Artist.id, c.c.c.label('albums')).join(c).order_by(Artist.name_key).all():
 
-		if index in map(str, xrange(10)):
-			index = '#'
-		elif index not in string.letters:
-			index = '?'
+		index = index_name(artist.name_key)
 
 		if index not in indexes:
 			indexes[index] = []
@@ -178,7 +181,7 @@ def album_info():
 		return res
 
 	info = res.as_subsonic_album(request.user)
-	info['song'] = [ t.as_subsonic_child(request.user) for t in sorted(res.tracks, key = lambda t: t.sort_key()) ]
+	info['song'] = Track.as_subsonic_children(sorted(res.tracks, key = lambda t: t.sort_key()), request.user)
 
 	return request.formatter({ 'album': info })
 
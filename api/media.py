@@ -20,23 +20,20 @@
 
 import traceback
 import sys
+import time
 from flask import request, send_file, Response
 import requests
 import os.path
-from PIL import Image
-from StringIO import StringIO
-import subprocess
 import codecs
 from xml.etree import ElementTree
-import ushlex as shlex
-import fnmatch
 import mimetypes
-from mediafile import MediaFile
-import mutagen
+from itertools import chain
 
 import config
 from web import app
 from db import Track, Album, Artist, Folder, ClientPrefs, now, session
+from covers import CoverCache, find_cover, art_location, cover_data, cover_sizes, render
+from transcoding import TranscodeCache, TranscodeSupervisor, TranscodingError, TranscodersBusy, ProcessStream, transcoding_target, transcoding_commands, can_seek
 from . import get_entity
 
 from sqlalchemy import func
@@ -58,16 +55,40 @@ def per_request_callbacks(response):
     return response
 
 
-def prepare_transcoding_cmdline(base_cmdline, input_file,
-                                input_format, output_format, output_bitrate):
-    if not base_cmdline:
-        return None
+transcode_cache = TranscodeCache()
+supervisor = TranscodeSupervisor()
+cover_cache = CoverCache()
 
-    return base_cmdline\
-        .replace('%srcpath', '"'+input_file+'"')\
-        .replace('%srcfmt', input_format)\
-        .replace('%outfmt', output_format)\
-        .replace('%outrate', str(output_bitrate))
+
+class StreamTimer:
+    """Collects the time spent in each step of a stream request, up to the
+    first byte sent to the client. For files sent as they are, cached
+    renditions included, the first byte is considered sent once the response
+    is ready."""
+
+    def __init__(self, track):
+        self.__track = track
+        self.__start = self.__last = time.time()
+        self.__steps = []
+        self.__logged = False
+
+    def mark(self, step):
+        now = time.time()
+        self.__steps.append((step, now - self.__last))
+        self.__last = now
+
+    def header(self):
+        return ', '.join('%s;dur=%.1f' % (step, elapsed * 1000) for step, elapsed in self.__steps)
+
+    def first_byte(self):
+        if self.__logged:
+            return
+
+        self.mark('first_byte')
+        self.__logged = True
+        app.logger.debug('Stream timing for %s: %s, time to first byte: %.1fms', self.__track,
+            ', '.join('%s %.1fms' % (step, elapsed * 1000) for step, elapsed in self.__steps),
+            (self.__last - self.__start) * 1000)
 
 
 @app.route('/rest/stream.view', methods=['GET', 'POST'])
@@ -82,111 +103,123 @@ def stream_media():
 
         return resp
 
-    def transcode(process):
+    def timed(stream, source):
         try:
-            for chunk in iter(process.stdout.readline, ''):
+            for chunk in stream:
+                timer.first_byte()
                 yield chunk
-            process.wait()
-        except:
-            traceback.print_exc()
-            process.terminate()
-            process.wait()
+        finally:
+            # Stops the transcoder when the client goes away
+            source.close()
 
+    timer = StreamTimer(request.args.get('id'))
     status, res = get_entity(request, Track)
 
     if not status:
         return res
 
-    maxBitRate, format, timeOffset, size, estimateContentLength, client = map(request.args.get, [ 'maxBitRate', 'format', 'timeOffset', 'size', 'estimateContentLength', 'c' ])
+    timer.mark('lookup')
+
+    # estimateContentLength is ignored, see below
+    maxBitRate, format, timeOffset, client = map(request.args.get, [ 'maxBitRate', 'format', 'timeOffset', 'c' ])
     if format:
         format = format.lower()
 
-    do_transcoding = False
-    src_suffix = res.suffix()
-    dst_suffix = src_suffix
-    dst_bitrate = res.bitrate
-    dst_mimetype = mimetypes.guess_type('a.' + src_suffix)
-
     if maxBitRate:
         try:
             maxBitRate = int(maxBitRate)
         except:
             return request.error_formatter(0, 'Invalid bitrate value')
 
-        if dst_bitrate > maxBitRate and maxBitRate != 0:
-            do_transcoding = True
-            dst_bitrate = maxBitRate
-
-    if format and format != 'raw' and format != src_suffix:
-        do_transcoding = True
-        dst_suffix = format
-        dst_mimetype = mimetypes.guess_type(dst_suffix)
+    try:
+        timeOffset = int(timeOffset) if timeOffset else 0
+    except:
+        return request.error_formatter(0, 'Invalid time offset value')
 
+    prefs = None
     if client:
         prefs = session.query(ClientPrefs).get((request.user.id, client))
         if not prefs:
             prefs = ClientPrefs(user_id = request.user.id, client_name = client)
             session.add(prefs)
 
-        if prefs.format:
-            dst_suffix = prefs.format
-        if prefs.bitrate and prefs.bitrate < dst_bitrate:
-            dst_bitrate = prefs.bitrate
-
-
-    if not format and src_suffix == 'flac':
-        dst_suffix = 'ogg'
-        dst_bitrate = 320
-        dst_mimetype = 'audio/ogg'
-        do_transcoding = True
-
-    duration = mutagen.File(res.path).info.length
+    src_suffix = res.suffix()
+    do_transcoding, dst_suffix, dst_bitrate = transcoding_target(res, format, maxBitRate, prefs)
+    # Client preferences may name a format while the file is sent as it is
+    if not do_transcoding or dst_suffix == src_suffix:
+        dst_mimetype = res.content_type or mimetypes.guess_type('a.' + src_suffix)[0]
+    else:
+        dst_mimetype = config.get('mimetypes', dst_suffix) or mimetypes.guess_type('a.' + dst_suffix)[0] or 'audio/' + dst_suffix
 
-    if do_transcoding:
-        transcoder = config.get('transcoding', 'transcoder_{}_{}'.format(src_suffix, dst_suffix))
+    # Stored metadata, reading the file headers here would delay the first byte
+    duration = res.precise_duration or res.duration
+    timer.mark('prefs')
 
-        decoder = config.get('transcoding', 'decoder_' + src_suffix) or config.get('transcoding', 'decoder')
-        encoder = config.get('transcoding', 'encoder_' + dst_suffix) or config.get('transcoding', 'encoder')
+    # Seeking restarts the transcoder at the offset, partial streams aren't cached
+    seek = do_transcoding and timeOffset > 0 and can_seek(src_suffix, dst_suffix)
+    use_cache = do_transcoding and not seek and transcode_cache.enabled
 
-        if not transcoder and (not decoder or not encoder):
-            transcoder = config.get('transcoding', 'transcoder')
-            if not transcoder:
-                return request.error_formatter(0, 'No way to transcode from {} to {}'.format(src_suffix, dst_suffix))
+    key = TranscodeCache.key(res, dst_suffix, dst_bitrate)
+    cached = transcode_cache.get(key) if use_cache else None
 
-        transcoder, decoder, encoder = map(lambda x: prepare_transcoding_cmdline(x, res.path, src_suffix, dst_suffix, dst_bitrate), [ transcoder, decoder, encoder ])
+    response = None
+    if cached:
+        # Same rendition already transcoded, for this request or another one. Range requests are answered from it.
+        response = send_file(cached, conditional = True)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers['Content-Type'] = dst_mimetype
+        response.headers['X-Content-Duration'] = str(duration)
+        timer.mark('cache')
 
-        if '|' in transcoder:
-            pipe_index = transcoder.index('|')
-            decoder = transcoder[:pipe_index]
-            encoder = transcoder[pipe_index+1:]
-            transcoder = None
+    elif do_transcoding:
+        try:
+            commands = transcoding_commands(res.path, src_suffix, dst_suffix, dst_bitrate, timeOffset if seek else 0)
+        except TranscodingError, e:
+            return request.error_formatter(0, str(e))
 
+        start = lambda: supervisor.start(commands, request.user.id)
         try:
-            if not transcoder:
-                decoder = map(lambda s: s.decode('UTF8'), shlex.split(decoder.encode('utf8')))
-                encoder = map(lambda s: s.decode('UTF8'), shlex.split(encoder.encode('utf8')))
-                dec_proc = subprocess.Popen(decoder, stdout = subprocess.PIPE, shell=False)
-                proc = subprocess.Popen(encoder, stdin=dec_proc.stdout, stdout=subprocess.PIPE, shell=False)
+            if use_cache:
+                source = transcode_cache.stream(key, start)
+                # A rendition failing before its first chunk gets an error response rather than an empty stream
+                stream = chain([ next(source, '') ], source)
             else:
-                transcoder = map(lambda s: s.decode('UTF8'), shlex.split(transcoder.encode('utf8')))
-                proc = subprocess.Popen(transcoder, stdout = subprocess.PIPE, shell=False)
-
-            response = Response(transcode(proc), 200, {'Content-Type': dst_mimetype, 'X-Content-Duration': str(duration)})
+                source = ProcessStream(start())
+                stream = source
+            timer.mark('spawn')
+
+            # No Content-Length, even if estimateContentLength asks for one: an estimate never matches the transcoder
+            # output. Cached renditions are sent with their actual size.
+            headers = {'Content-Type': dst_mimetype, 'X-Content-Duration': str(duration)}
+            response = Response(timed(stream, source), 200, headers)
+        except TranscodersBusy, e:
+            # Only clients that didn't ask for a specific format can do with the original file
+            if format and format != 'raw':
+                return request.error_formatter(0, str(e))
+            app.logger.info('Transcoders busy, sending %s as is', res.path)
+            do_transcoding = False
+            dst_mimetype = res.content_type or mimetypes.guess_type('a.' + src_suffix)[0]
         except:
             traceback.print_exc()
             return request.error_formatter(0, 'Error while running the transcoding process: {}'.format(sys.exc_info()[1]))
 
-    else:
-        response = send_file(res.path.encode('utf-8'))
+    if response is None:
+        response = send_file(res.path.encode('utf-8'), conditional = True)
         response.headers['Content-Type'] = dst_mimetype
         response.headers['Accept-Ranges'] = 'bytes'
         response.headers['X-Content-Duration'] = str(duration)
+        timer.mark('open')
 
     res.play_count = res.play_count + 1
     res.last_play = now()
     request.user.last_play = res
     request.user.last_play_date = now()
     session.commit()
+    timer.mark('commit')
+
+    response.headers['Server-Timing'] = timer.header()
+    if cached or not do_transcoding:
+        timer.first_byte()
 
     return response
 
@@ -200,6 +233,12 @@ def download_media():
     return send_file(res.path)
 
 
+def forget_cover(folder):
+    # Remembered as none, so that the next requests don't open every track again
+    folder.cover_art = u''
+    folder.cover_art_offset = folder.cover_art_length = None
+    session.commit()
+
 @app.route('/rest/getCoverArt.view', methods = [ 'GET', 'POST' ])
 def cover_art():
 
@@ -217,41 +256,6 @@ def cover_art():
     if not status:
         return res
 
-    # Check the folder id given for jpgs
-    app.logger.debug('Cover Art Check: ' + res.path + '/*.jp*g')
-
-    coverfile = os.listdir(res.path)
-    coverfile = fnmatch.filter(coverfile, '*.jp*g')
-
-    # when there is not a jpeg in the folder check files for embedded art
-    if not coverfile:
-        app.logger.debug('No Art Found in Folder, Checking Files!')
-
-        for tr in res.tracks:
-            app.logger.debug('Checking ' + tr.path + ' For Artwork')
-
-            try:
-                mf = MediaFile(tr.path)
-                coverfile = getattr(mf, 'art')
-
-                if coverfile is not None:
-                    if type(coverfile) is list:
-                        coverfile = coverfile[0]
-                    coverfile = StringIO(coverfile)
-                    app.logger.debug('Serving embedded cover art')
-                    break
-
-            except:
-                app.logger.debug('Problem reading embedded art')
-                return request.error_formatter(70, 'Cover art not found'), 404
-
-            return request.error_formatter(70, 'Cover art not found'), 404
-    else:
-        app.logger.debug('Found Images: ' + str(coverfile))
-        coverfile = coverfile[0]
-        coverfile = os.path.join(res.path, coverfile)
-        app.logger.debug('Serving cover art: ' + coverfile)
-
     size = request.args.get('size')
     if size:
         try:
@@ -261,31 +265,52 @@ def cover_art():
     else:
         size = 1000
 
-    im = Image.open(coverfile)
-
-    size_path = os.path.join(config.get('base', 'cache_dir'), str(size))
-    path = os.path.join(size_path, str(res.id))
-
-    if not os.path.exists(size_path):
-        os.makedirs(size_path)
-
-    if size > im.size[0] and size > im.size[1]:
-        app.logger.debug('Not resizing Image, adding to cache')
-        im.save(path, 'JPEG')
-        return send_file(path)
-
-    app.logger.debug('Saving resized image to: ' + path)
-
-    if os.path.exists(path):
-        app.logger.debug('Serving cover art: ' + path)
-        return send_file(path)
+    # Cached images are served without looking into the folder nor decoding anything.
+    # ETag and If-None-Match are handled by send_file.
+    source = res.cover_art
+    if source == u'':
+        # Already looked for, the folder has to be scanned again for new art to be found
+        return request.error_formatter(70, 'Cover art not found'), 404
 
+    try:
+        mtime = int(os.path.getmtime(source)) if source else None
+    except OSError:
+        source = None
+
+    if source:
+        path = cover_cache.get(res.id, size, mtime)
+        if path:
+            app.logger.debug('Serving cached cover art: ' + path)
+            return send_file(path, mimetype = 'image/jpeg', conditional = True)
+    else:
+        # Not found by the scanner, or gone since
+        source = find_cover(res)
+        if not source:
+            forget_cover(res)
+            return request.error_formatter(70, 'Cover art not found'), 404
 
-    im.thumbnail([size, size], Image.ANTIALIAS)
-    im.save(path, 'JPEG')
+        res.cover_art = source
+        res.cover_art_offset, res.cover_art_length = art_location(source) or (None, None)
+        session.commit()
+        mtime = int(os.path.getmtime(source))
 
+    # The configured sizes that are missing are rendered along, from the same decoded image
+    app.logger.debug('Resizing cover art from: ' + source)
+    sizes = [ size ] + [ s for s in cover_sizes() if s != size and not cover_cache.get(res.id, s, mtime) ]
+    try:
+        data = cover_data(source, res.cover_art_offset, res.cover_art_length)
+        rendered = render(data, sizes) if data else None
+    except IOError:
+        rendered = None
+    if not rendered:
+        app.logger.warn('Invalid cover art: ' + source)
+        forget_cover(res)
+        return request.error_formatter(70, 'Cover art not found'), 404
+
+    paths = dict((s, cover_cache.put(res.id, s, image, mtime)) for s, image in rendered.iteritems())
+    path = paths[size]
     app.logger.debug('Serving cover art: ' + path)
-    return send_file(path)
+    return send_file(path, mimetype = 'image/jpeg', conditional = True)
 
 @app.route('/rest/getLyrics.view', methods = [ 'GET', 'POST' ])
 def lyrics():
@@ -20,7 +20,21 @@
 
 from flask import request
 from web import app
-from db import Folder, Track, Artist, Album, session
+from db import Folder, Track, Artist, Album, name_key, session
+from fulltext import search_index, ARTIST, ALBUM, TRACK, ARTIST_FOLDER, ALBUM_FOLDER
+
+def indexed_search(kind, ent, query, offset, count, fallback):
+	"""Entities of a kind matching query, best ranked first. Without a
+	built full-text index the fallback query is used."""
+
+	index = search_index()
+	if not index or not index.ready():
+		return fallback.slice(offset, offset + count).all()
+
+	ids, total = index.search(kind, query, offset, count)
+	found = dict((e.id, e) for e in session.query(ent).filter(ent.id.in_(ids))) if ids else {}
+	# Documents not indexed again yet may be gone
+	return [ found[i] for i in ids if i in found ]
 
 @app.route('/rest/search.view', methods = [ 'GET', 'POST' ])
 def old_search():
@@ -33,24 +47,27 @@ def old_search():
 		return request.error_formatter(0, 'Invalid parameter')
 
 	if artist:
-		query = session.query(Folder).filter(~ Folder.tracks.any(), Folder.name.contains(artist))
+		ent = Folder
+		query = session.query(Folder).filter(~ Folder.tracks.any(), Folder.name_key.contains(name_key(artist)))
 	elif album:
-		query = session.query(Folder).filter(Folder.tracks.any(), Folder.name.contains(album))
+		ent = Folder
+		query = session.query(Folder).filter(Folder.tracks.any(), Folder.name_key.contains(name_key(album)))
 	elif title:
-		query = session.query(Track).filter(Track.title.contains(title))
+		ent = Track
+		query = session.query(Track).filter(Track.title_key.contains(name_key(title)))
 	elif anyf:
-		folders = session.query(Folder).filter(Folder.name.contains(anyf))
-		tracks = session.query(Track).filter(Track.title.contains(anyf))
-		res = folders.slice(offset, offset + count).all()
+		folders = session.query(Folder).filter(Folder.name_key.contains(name_key(anyf)))
+		tracks = session.query(Track).filter(Track.title_key.contains(name_key(anyf)))
+		res = Folder.as_subsonic_children(folders.slice(offset, offset + count), request.user)
 		if offset + count > folders.count():
 			toff = max(0, offset - folders.count())
 			tend = offset + count - folders.count()
-			res += tracks.slice(toff, tend).all()
+			res += Track.as_subsonic_children(tracks.slice(toff, tend), request.user)
 
 		return request.formatter({ 'searchResult': {
 			'totalHits': folders.count() + tracks.count(),
 			'offset': offset,
-			'match': [ r.as_subsonic_child(request.user) for r in res ]
+			'match': res
 			}})
 	else:
 		return request.error_formatter(10, 'Missing search parameter')
@@ -58,7 +75,7 @@ def old_search():
 	return request.formatter({ 'searchResult': {
 		'totalHits': query.count(),
 		'offset': offset,
-		'match': [ r.as_subsonic_child(request.user) for r in query.slice(offset, offset + count) ]
+		'match': ent.as_subsonic_children(query.slice(offset, offset + count), request.user)
 		}})
 
 
@@ -80,14 +97,19 @@ def new_search():
 	if not query:
 		return request.error_formatter(10, 'Missing query parameter')
 
-	artist_query = session.query(Folder).filter(~ Folder.tracks.any(), Folder.path.contains(query)).slice(artist_offset, artist_offset + artist_count)
-	album_query = session.query(Folder).filter(Folder.tracks.any(), Folder.path.contains(query)).slice(album_offset, album_offset + album_count)
-	song_query = sesion.query(Track).filter(Track.title.contains(query)).slice(song_offset, song_offset + song_count)
+	# Without the full-text index, names are matched by their name key whatever their case and accents
+	key = name_key(query)
+	artist_query = indexed_search(ARTIST_FOLDER, Folder, query, artist_offset, artist_count,
+		session.query(Folder).filter(~ Folder.tracks.any(), Folder.name_key.contains(key)))
+	album_query = indexed_search(ALBUM_FOLDER, Folder, query, album_offset, album_count,
+		session.query(Folder).filter(Folder.tracks.any(), Folder.name_key.contains(key)))
+	song_query = indexed_search(TRACK, Track, query, song_offset, song_count,
+		session.query(Track).filter(Track.title_key.contains(key)))
 
 	return request.formatter({ 'searchResult2': {
 		'artist': [ { 'id': a.id, 'name': a.name } for a in artist_query ],
-		'album': [ f.as_subsonic_child(request.user) for f in album_query ],
-		'song': [ t.as_subsonic_child(request.user) for t in song_query ]
+		'album': Folder.as_subsonic_children(album_query, request.user),
+		'song': Track.as_subsonic_children(song_query, request.user)
 	}})
 
 
@@ -109,13 +131,17 @@ def search_id3():
 	if not query:
 		return request.error_formatter(10, 'Missing query parameter')
 
-	artist_query = session.query(Artist).filter(Artist.name.contains(query)).slice(artist_offset, artist_offset + artist_count)
-	album_query = session.query(Album).filter(Album.name.contains(query)).slice(album_offset, album_offset + album_count)
-	song_query = session.query(Track).filter(Track.title.contains(query)).slice(song_offset, song_offset + song_count)
+	key = name_key(query)
+	artist_query = indexed_search(ARTIST, Artist, query, artist_offset, artist_count,
+		session.query(Artist).filter(Artist.name_key.contains(key)))
+	album_query = indexed_search(ALBUM, Album, query, album_offset, album_count,
+		session.query(Album).filter(Album.name_key.contains(key)))
+	song_query = indexed_search(TRACK, Track, query, song_offset, song_count,
+		session.query(Track).filter(Track.title_key.contains(key)))
 
 	return request.formatter({ 'searchResult2': {
 		'artist': [ a.as_subsonic_artist(request.user) for a in artist_query ],
 		'album': [ a.as_subsonic_album(request.user) for a in album_query ],
-		'song': [ t.as_subsonic_child(request.user) for t in song_query ]
+		'song': Track.as_subsonic_children(song_query, request.user)
 		}})
 
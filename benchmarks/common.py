@@ -0,0 +1,69 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Helpers shared by the benchmark scripts.
+
+The benchmarks run against a throw-away in-memory SQLite database unless
+another database URI is given through the SUPYSONIC_BENCH_DB environment
+variable, they never touch the configured library.
+"""
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+if not config.config.has_section('base'):
+    config.config.add_section('base')
+config.config.set('base', 'database_uri', os.environ.get('SUPYSONIC_BENCH_DB', 'sqlite://'))
+
+from sqlalchemy import event
+
+# web first: db imports it, and it imports modules that need db complete
+import web
+import db
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        event.listen(db.database.engine, 'before_cursor_execute', self.__count)
+
+    def __count(self, *args):
+        self.count += 1
+
+    def reset(self):
+        self.count = 0
+
+def reset_db():
+    db.session.remove()
+    db.metadata.drop_all()
+    db.metadata.create_all()
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    ret = func(*args, **kwargs)
+    return time.time() - start, ret
+
+def report(title, header, rows):
+    print title
+    print '\t'.join(header)
+    for row in rows:
+        print '\t'.join(map(str, row))
+    print
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares the JSON responses as they used to be written, pruning empty
+lists beforehand then indenting with simplejson and a catch-all encoder,
+with dict2json_chunks, on getAlbumList2 like payloads.
+
+    python benchmarks/json_responses.py
+"""
+
+import uuid
+import simplejson
+
+from common import timed, report
+
+from dict2json import dict2json_chunks
+
+SIZES = [ 10, 50, 100, 500 ]
+REPEAT = 100
+
+class SupysonicEncoder(simplejson.JSONEncoder):
+    def default(self, o):
+        return unicode(o)
+
+def check_lists(d):
+    for key, value in d.items():
+        if isinstance(value, dict):
+            d[key] = check_lists(value)
+        elif isinstance(value, list):
+            if len(value) == 0:
+                del d[key]
+            else:
+                d[key] = [ check_lists(item) if isinstance(item, dict) else item for item in value ]
+    return d
+
+def album_list(count):
+    return { 'subsonic-response': {
+        'status': 'ok', 'version': '1.8.0', 'xmlns': 'http://subsonic.org/restapi',
+        'albumList2': { 'album': [ {
+            'id': uuid.uuid4(), 'name': u'Album "%i"' % i, 'artist': u'Artist é %i' % (i / 10), 'artistId': uuid.uuid4(),
+            'songCount': 12, 'duration': 2880, 'created': u'2014-01-01T00:00:00', 'year': 2000 + i % 15,
+            'coverArt': uuid.uuid4(), 'starred': u'2014-01-01T00:00:00'
+        } for i in xrange(count) ] }
+    } }
+
+def indented(payload):
+    for i in xrange(REPEAT):
+        output = simplejson.dumps(check_lists(payload), indent = True, encoding = 'utf-8', cls = SupysonicEncoder)
+    return len(output)
+
+def chunked(payload):
+    for i in xrange(REPEAT):
+        output = ''.join(dict2json_chunks(payload))
+    return len(output)
+
+if __name__ == '__main__':
+    rows = []
+    for size in SIZES:
+        payload = album_list(size)
+        before, before_length = timed(indented, payload)
+        after, after_length = timed(chunked, payload)
+        rows.append((size, before_length, after_length, '%.2f' % (before / REPEAT * 1000), '%.2f' % (after / REPEAT * 1000), '%.1f' % (before / after)))
+
+    report('getAlbumList2 JSON responses', [ 'albums', 'chars before', 'chars after', 'ms before', 'ms after', 'speedup' ], rows)
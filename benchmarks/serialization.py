@@ -0,0 +1,78 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Counts the queries needed to serialize lists of tracks of growing size,
+comparing per-row Track.as_subsonic_child calls with the bulk
+Track.as_subsonic_children.
+
+    python benchmarks/serialization.py
+"""
+
+from common import QueryCounter, reset_db, timed, report
+
+from db import chunks, User, Folder, Artist, Album, Track, StarredTrack, RatingTrack, session
+
+SIZES = [ 10, 100, 500, 2000 ]
+
+def populate(count):
+    reset_db()
+
+    user = User(name = u'bench', password = '\0' * 20)
+    root = Folder(root = True, path = u'/nonexistent')
+    session.add_all([ user, root ])
+
+    tracks = []
+    for i in xrange(count):
+        if i % 10 == 0:
+            folder = Folder(path = u'/nonexistent/%i' % i, parent = root)
+            album = Album(name = u'Album %i' % i, artist = Artist(name = u'Artist %i' % i))
+        track = Track(disc = 1, number = i % 10 + 1, title = u'Track %i' % i, artist = u'Artist', duration = 180, bitrate = 320,
+            path = u'/nonexistent/%i/%i.mp3' % (i - i % 10, i), last_modification = 0, folder = folder, album = album)
+        tracks.append(track)
+        if i % 3 == 0:
+            session.add(StarredTrack(user = user, starred = track))
+        if i % 4 == 0:
+            session.add(RatingTrack(user = user, rated = track, rating = i % 5 + 1))
+
+    session.add_all(tracks)
+    session.commit()
+    return user.id, [ t.id for t in tracks ]
+
+def run(counter, serialize, user_id, track_ids):
+    # Start from an empty identity map so lazy loads aren't hidden by the populating step
+    session.expunge_all()
+    user = session.query(User).get(user_id)
+    tracks = [ t for chunk in chunks(track_ids) for t in session.query(Track).filter(Track.id.in_(chunk)) ]
+
+    counter.reset()
+    elapsed, _ = timed(serialize, tracks, user)
+    return counter.count, '%.3f' % elapsed
+
+if __name__ == '__main__':
+    counter = QueryCounter()
+
+    rows = []
+    for size in SIZES:
+        user_id, track_ids = populate(size)
+        per_row = run(counter, lambda tracks, user: [ t.as_subsonic_child(user) for t in tracks ], user_id, track_ids)
+        bulk = run(counter, Track.as_subsonic_children, user_id, track_ids)
+        rows.append((size,) + per_row + bulk)
+
+    report('Track serialization', [ 'tracks', 'queries/row', 'time/row', 'queries/bulk', 'time/bulk' ], rows)
@@ -0,0 +1,74 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares reading a transcoder output line by line, as stream_media used
+to, with the fixed size chunks of ProcessStream. The transcoder is stood in
+for by cat on a file of random bytes, and every chunk is written to
+/dev/null as it would be to the client socket.
+
+    python benchmarks/transcode_reads.py
+"""
+
+import os, tempfile
+
+from common import timed, report
+
+from transcoding import ProcessStream, start_transcoding
+
+SIZE = 64 * 1024 * 1024
+CHUNK_SIZES = [ 4096, 8192, 16384, 65536 ]
+
+def consume(chunks, out):
+    count, smallest, largest = 0, None, 0
+    for chunk in chunks:
+        os.write(out, chunk)
+        count += 1
+        smallest = len(chunk) if smallest is None else min(smallest, len(chunk))
+        largest = max(largest, len(chunk))
+    return count, smallest, largest
+
+def readline(path, out):
+    proc = start_transcoding([ [ 'cat', path ] ])
+    ret = consume(iter(proc.stdout.readline, ''), out)
+    proc.wait()
+    return ret
+
+def chunked(path, out, size):
+    return consume(ProcessStream(start_transcoding([ [ 'cat', path ] ]), size), out)
+
+if __name__ == '__main__':
+    fd, path = tempfile.mkstemp(prefix = 'supysonic-bench-')
+    out = os.open(os.devnull, os.O_WRONLY)
+    try:
+        for i in xrange(SIZE / (1024 * 1024)):
+            os.write(fd, os.urandom(1024 * 1024))
+        os.close(fd)
+
+        rows = []
+        elapsed, (count, smallest, largest) = timed(readline, path, out)
+        rows.append(('readline', '%.1f' % (SIZE / elapsed / 1024 / 1024), count, smallest, largest))
+        for size in CHUNK_SIZES:
+            elapsed, (count, smallest, largest) = timed(chunked, path, out, size)
+            rows.append(('chunks of %i' % size, '%.1f' % (SIZE / elapsed / 1024 / 1024), count, smallest, largest))
+    finally:
+        os.close(out)
+        os.remove(path)
+
+    report('Transcoder output reads (%i MiB)' % (SIZE / 1024 / 1024), [ 'method', 'MiB/s', 'chunks', 'smallest', 'largest' ], rows)
@@ -0,0 +1,70 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares building XML responses as a whole with dict2xml with writing
+them in chunks with dict2xml_chunks, on getIndexes and getStarred like
+payloads of growing size.
+
+    python benchmarks/xml_responses.py
+"""
+
+import uuid
+
+from common import timed, report
+
+from dict2xml import dict2xml, dict2xml_chunks
+
+SIZES = [ 500, 2000, 5000, 10000 ]
+
+def indexes(count):
+    artists = [ { 'id': uuid.uuid4(), 'name': u'Artist & Co %i' % i } for i in xrange(count) ]
+    return { 'indexes': {
+        'lastModified': 1400000000000,
+        'index': [ { 'name': unichr(65 + i), 'artist': artists[i::26] } for i in xrange(26) ]
+    } }
+
+def starred(count):
+    return { 'starred': { 'song': [ {
+        'id': uuid.uuid4(), 'parent': uuid.uuid4(), 'isDir': False, 'title': u'Track <%i>' % i,
+        'album': u'Album "%i"' % (i / 10), 'artist': u'Artist %i' % (i / 100), 'track': i % 10 + 1,
+        'year': 2000 + i % 15, 'genre': u'Rock', 'coverArt': uuid.uuid4(), 'size': 8000000 + i,
+        'contentType': u'audio/mpeg', 'suffix': u'mp3', 'duration': 240, 'bitRate': 320,
+        'path': u'Artist %i/Album %i/%02i - Track %i.mp3' % (i / 100, i / 10, i % 10 + 1, i),
+        'created': u'2014-01-01T00:00:00', 'starred': u'2014-01-01T00:00:00', 'type': u'music'
+    } for i in xrange(count) ] } }
+
+def chunked(payload):
+    chunks = dict2xml_chunks(payload, 'subsonic-response')
+    first, _ = timed(next, chunks)
+    largest = 0
+    for chunk in chunks:
+        largest = max(largest, len(chunk))
+    return first, largest
+
+if __name__ == '__main__':
+    rows = []
+    for name, build in (('getIndexes', indexes), ('getStarred', starred)):
+        for size in SIZES:
+            payload = build(size)
+            whole, output = timed(dict2xml, payload, 'subsonic-response')
+            streamed, (first, largest) = timed(chunked, payload)
+            rows.append((name, size, len(output), '%.3f' % whole, '%.3f' % streamed, '%.1f' % (first * 1000), largest))
+
+    report('XML responses', [ 'payload', 'entries', 'chars', 'dict2xml', 'chunks', 'first chunk (ms)', 'largest chunk' ], rows)
@@ -23,9 +23,13 @@ import config
 from web import app
 from flask.ext.script import Manager, Command, Option, prompt_pass
 import os.path
+import sys
 from managers.folder import FolderManager
 from managers.user import UserManager
 from scanner import Scanner
+from transcoding import TranscodeCache, TranscodeSupervisor, PreTranscoder
+from covers import CoverRenderer
+from fulltext import search_index
 
 from db import User, Folder, session, metadata
 
@@ -59,16 +63,22 @@ def folder_delete(path):
     else:
         print "Deleted folder" + path
 
-@manager.command
-def folder_scan():
-    s = Scanner(session)
+@manager.option('-j', '--jobs', dest = 'jobs', type = int, default = 1, help = 'Number of processes reading tags')
+@manager.option('-b', '--bulk', dest = 'bulk', action = 'store_true', help = 'Write to the database with bulk inserts and updates')
+def folder_scan(jobs, bulk):
+    "Scan all folders of the Library"
+    s = Scanner(session, jobs = jobs, bulk = bulk)
+
+    def progress(scanned, added):
+        sys.stdout.write('\033[K%i files scanned, %i tracks added\r' % (scanned, added))
+        sys.stdout.flush()
 
     folders = session.query(Folder).filter(Folder.root == True)
 
     if folders:
         for folder in folders:
             print "Scanning: " + folder.path
-            FolderManager.scan(folder.id, s)
+            FolderManager.scan(folder.id, s, progress)
 
         added, deleted = s.stats()
 
@@ -76,6 +86,59 @@ def folder_scan():
         print "Scanning done"
         print 'Added: %i artists, %i albums, %i tracks' % (added[0], added[1], added[2])
         print 'Deleted: %i artists, %i albums, %i tracks' % (deleted[0], deleted[1], deleted[2])
+        directories, files = s.resumed()
+        if directories or files:
+            print 'Resumed from checkpoints: skipped %i directories, %i files' % (directories, files)
+        print 'Peak memory usage: %i MiB' % s.peak_memory()
+
+@manager.command
+def folder_watch():
+    "Watch the Library folders and update the database as files change"
+    try:
+        from watcher import SupysonicWatcher
+    except ImportError:
+        print >>sys.stderr, 'The folder watcher requires pyinotify'
+        return
+
+    SupysonicWatcher().run()
+
+@manager.option('-c', '--count', dest = 'count', type = int, default = 100, help = 'Number of most played and of recently played tracks')
+@manager.option('-d', '--days', dest = 'days', type = int, default = 7, help = 'Tracks played within that many days are recently played')
+@manager.option('-j', '--jobs', dest = 'jobs', type = int, default = 2, help = 'Number of concurrent transcodings')
+@manager.option('-n', '--nice', dest = 'nice', type = int, default = 10, help = 'Niceness increment of the transcoding processes')
+def transcode_warm(count, days, jobs, nice):
+    "Transcode the streams of popular tracks ahead of time"
+    cache = TranscodeCache()
+    if not cache.enabled:
+        print >>sys.stderr, 'The transcode cache is disabled'
+        return
+
+    transcoded, cached = PreTranscoder(cache, TranscodeSupervisor(), jobs = jobs, nice = nice).run(count, days)
+    print 'Transcoded %i streams, %i already cached' % (transcoded, cached)
+
+@manager.command
+def transcode_status():
+    "Show the number of transcodings in progress"
+    host, users = TranscodeSupervisor().counts()
+    print 'Transcodings in progress: %i' % host
+    for user_id, count in users.iteritems():
+        user = session.query(User).get(user_id)
+        print '{0: <16}{1}'.format(user.name if user else user_id, count)
+
+@manager.option('-j', '--jobs', dest = 'jobs', type = int, default = 1, help = 'Number of processes rendering images')
+def cover_render(jobs):
+    "Render the cover art of all folders at the configured sizes ahead of time"
+    print 'Rendered %i images' % CoverRenderer(jobs = jobs).run()
+
+@manager.command
+def search_update():
+    "Build the full-text search index, or bring it up to date"
+    index = search_index()
+    if not index:
+        print >>sys.stderr, 'The search index is disabled'
+        return
+
+    print 'Updated %i documents of the %s search index' % (index.update(), index.name)
 
 @manager.command
 def folder_prune():
@@ -0,0 +1,417 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path
+import errno
+import fnmatch
+import multiprocessing
+import struct
+import tempfile
+import time
+from PIL import Image
+from StringIO import StringIO
+from mediafile import MediaFile
+
+import config
+from web import app
+from db import Folder, session
+
+# Image files named like that are preferred over the other ones of a folder
+PREFERRED_NAMES = [ 'cover', 'folder', 'front', 'album' ]
+
+def is_image(name):
+    return fnmatch.fnmatch(name, '*.jp*g')
+
+def best_image(names):
+    """Returns the file name most likely to be the cover art among those of a
+    directory, None if there's no image"""
+
+    def rank(name):
+        base = os.path.splitext(name)[0].lower()
+        return (PREFERRED_NAMES.index(base) if base in PREFERRED_NAMES else len(PREFERRED_NAMES), name)
+
+    images = filter(is_image, names)
+    return min(images, key = rank) if images else None
+
+def embedded_art(path):
+    """Returns the image data embedded in an audio file, None if there's none"""
+
+    try:
+        art = MediaFile(path).art
+    except:
+        app.logger.debug('Problem reading embedded art of ' + path)
+        return None
+
+    if type(art) is list:
+        art = art[0] if art else None
+    return art or None
+
+def art_location(path):
+    """Returns the offset and length of the picture embedded in an audio
+    file, when it is stored as it is: in a FLAC picture block, an ID3v2.3
+    or 2.4 APIC frame without unsynchronisation nor compression, or an MP4
+    covr atom. None otherwise, reading it then takes MediaFile."""
+
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(10)
+            offset = 0
+            if header[:3] == 'ID3':
+                location = _id3_location(f, header)
+                if location:
+                    return location
+                # FLAC files may start with an ID3 tag as well
+                offset = 10 + _syncsafe(header[6:10]) + (10 if ord(header[5]) & 0x10 else 0)
+                f.seek(offset)
+                header = f.read(10)
+
+            if header[:4] == 'fLaC':
+                return _flac_location(f, offset + 4)
+            if header[4:8] == 'ftyp':
+                return _mp4_location(f)
+    except (IOError, IndexError, ValueError, struct.error):
+        # Truncated or malformed, left to MediaFile
+        pass
+    return None
+
+def _syncsafe(data):
+    return reduce(lambda value, byte: (value << 7) | (ord(byte) & 0x7f), data, 0)
+
+def _id3_location(f, header):
+    version, flags = ord(header[3]), ord(header[5])
+    if version not in (3, 4) or flags & 0x80:
+        return None
+
+    tag = f.read(_syncsafe(header[6:10]))
+    pos = 0
+    if flags & 0x40:
+        # Extended header, its size excludes itself in 2.3
+        pos = _syncsafe(tag[:4]) if version == 4 else struct.unpack('>I', tag[:4])[0] + 4
+
+    found = None
+    while pos + 10 <= len(tag) and tag[pos] != '\0':
+        frame_id = tag[pos:pos + 4]
+        size = _syncsafe(tag[pos + 4:pos + 8]) if version == 4 else struct.unpack('>I', tag[pos + 4:pos + 8])[0]
+        # Compression, encryption, grouping and the 2.4 unsynchronisation and data length indicator
+        stored = not ord(tag[pos + 9]) & (0x4f if version == 4 else 0xe0)
+        body = pos + 10
+        pos = body + size
+
+        if frame_id != 'APIC' or not stored:
+            continue
+        if pos > len(tag):
+            return None
+
+        # Every field is looked for within the frame, a missing terminator raises ValueError
+        encoding = ord(tag[body])
+        start = tag.index('\0', body + 1, pos) + 1
+        if start >= pos:
+            return None
+        picture_type = ord(tag[start])
+        if encoding in (1, 2):
+            # UTF-16 descriptions end with two aligned null bytes
+            end = start + 1
+            while end + 2 <= pos and tag[end:end + 2] != '\0\0':
+                end += 2
+            if end + 2 > pos:
+                return None
+            start = end + 2
+        else:
+            start = tag.index('\0', start + 1, pos) + 1
+
+        location = (10 + start, pos - start)
+        if picture_type == 3:
+            return location
+        found = found or location
+
+    return found
+
+def _flac_location(f, offset):
+    found = None
+    last = False
+    while not last:
+        f.seek(offset)
+        header = f.read(4)
+        last = ord(header[0]) & 0x80
+        block_type = ord(header[0]) & 0x7f
+        size = struct.unpack('>I', '\0' + header[1:4])[0]
+
+        if block_type == 6:
+            block = f.read(size)
+            picture_type, mime_length = struct.unpack('>II', block[:8])
+            pos = 8 + mime_length
+            pos += 4 + struct.unpack('>I', block[pos:pos + 4])[0] + 16
+            length = struct.unpack('>I', block[pos:pos + 4])[0]
+
+            location = (offset + 4 + pos + 4, length)
+            if picture_type == 3:
+                return location
+            found = found or location
+        offset += 4 + size
+
+    return found
+
+def _mp4_atoms(f, start, end):
+    """Yields the type, content offset and end of the atoms in a range of an
+    MP4 file"""
+
+    pos = start
+    while end is None or pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+
+        size, atom_type = struct.unpack('>I4s', header)
+        content = pos + 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            content += 8
+        elif size == 0:
+            size = os.fstat(f.fileno()).st_size - pos
+        if size < content - pos:
+            return
+
+        yield atom_type, content, pos + size
+        pos += size
+
+def _mp4_location(f):
+    start, end = 0, None
+    # meta is a full atom, its version and flags come before its children
+    for atom_type, skip in (('moov', 0), ('udta', 0), ('meta', 4), ('ilst', 0), ('covr', 0), ('data', 0)):
+        for found, content, atom_end in _mp4_atoms(f, start, end):
+            if found == atom_type:
+                start, end = content + skip, atom_end
+                break
+        else:
+            return None
+
+    # Type and locale, then the image
+    return start + 8, end - start - 8
+
+def find_cover(folder):
+    """Returns the path of the cover art of a folder: an image file or an
+    audio file with embedded art, None if there's none"""
+
+    try:
+        image = best_image(os.listdir(folder.path))
+    except OSError:
+        image = None
+    if image:
+        return os.path.join(folder.path, image)
+
+    for tr in folder.tracks:
+        if embedded_art(tr.path):
+            return tr.path
+
+    return None
+
+def cover_data(path, offset = None, length = None):
+    """Returns the content of the cover art image of an image or audio file.
+    Embedded pictures are read straight from their offset when it is known."""
+
+    if is_image(os.path.basename(path)):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    if offset is not None:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(length)
+        # The file may have been modified since the offset was recorded
+        if data.startswith(('\xff\xd8', '\x89PNG')):
+            return data
+    return embedded_art(path)
+
+def encode(im):
+    out = StringIO()
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+    im.save(out, 'JPEG')
+    return out.getvalue()
+
+def render(data, sizes):
+    """Returns the JPEG images fitting in size x size squares for each of
+    sizes, keyed by size, from the content of an image.
+
+    The image is decoded once, JPEG ones at the lowest resolution draft mode
+    allows for the largest size, and each size is shrunk from the previous
+    one. Sizes the image already fits in get the original content when it is
+    a JPEG."""
+
+    im = Image.open(StringIO(data))
+    fmt = im.format
+    width, height = im.size
+
+    smaller = sorted((size for size in sizes if size < width or size < height), reverse = True)
+    larger = [ size for size in sizes if size not in smaller ]
+
+    rendered = {}
+    if larger:
+        original = data if fmt == 'JPEG' else encode(im)
+        for size in larger:
+            rendered[size] = original
+
+    if smaller:
+        if fmt == 'JPEG':
+            im.draft('RGB', (smaller[0], smaller[0]))
+        for size in smaller:
+            im = im.copy()
+            im.thumbnail([size, size], Image.ANTIALIAS)
+            rendered[size] = encode(im)
+
+    return rendered
+
+class CoverCache:
+    """Resized cover art under cache_dir/covers/<size>/<folder id>.
+
+    Each resized image gets the modification time of its source, the
+    cover_art of its folder, so that checking whether it is still valid
+    takes no decoding nor directory listing. Least recently accessed images
+    are evicted once the cache grows over its size limit."""
+
+    # Evicting lists the whole cache, so it isn't done after each new image
+    EVICT_INTERVAL = 60
+    # Shared by the instances of a process
+    last_eviction = 0
+
+    def __init__(self):
+        cache_dir = config.get('base', 'cache_dir') or os.path.join(tempfile.gettempdir(), 'supysonic')
+        self.__dir = os.path.join(cache_dir, 'covers')
+
+        # In MiB, 0 means no limit
+        size = config.get('base', 'cover_cache_size')
+        self.__max_size = int(size if size is not None else 256) * 1024 * 1024
+
+    def get(self, folder_id, size, source_mtime):
+        """Returns the path of the image of a folder resized to size, None if
+        it isn't cached or is older than its source"""
+
+        path = os.path.join(self.__dir, str(size), str(folder_id))
+        try:
+            if int(os.stat(path).st_mtime) != source_mtime:
+                return None
+            # The access time is what eviction goes by, the modification time is the source one
+            os.utime(path, (time.time(), source_mtime))
+        except OSError:
+            return None
+        return path
+
+    def put(self, folder_id, size, data, source_mtime):
+        """Stores the JPEG image of a folder resized to size, returns its path"""
+
+        path = os.path.join(self.__dir, str(size), str(folder_id))
+        self.__write(path, data)
+        os.utime(path, (time.time(), source_mtime))
+
+        if time.time() - CoverCache.last_eviction > self.EVICT_INTERVAL:
+            self.evict()
+        return path
+
+    def evict(self):
+        """Removes the least recently accessed images until the cache fits its
+        size limit"""
+
+        CoverCache.last_eviction = time.time()
+        if not self.__max_size:
+            return
+
+        entries = []
+        for subdir in os.listdir(self.__dir):
+            for name in os.listdir(os.path.join(self.__dir, subdir)):
+                path = os.path.join(self.__dir, subdir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_atime, st.st_size, path))
+
+        total = sum(size for atime, size, path in entries)
+        for atime, size, path in sorted(entries):
+            if total <= self.__max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def __write(self, path, data):
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Written aside then renamed, concurrent requests never see a partial image
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+def cover_sizes():
+    """Sizes cover art is rendered at ahead of time"""
+    return map(int, (config.get('base', 'cover_sizes') or '1000').split())
+
+def render_cover(item):
+    """Renders the missing sizes of the cover art of a folder. Runs in the
+    cover renderer worker processes."""
+
+    folder_id, source, offset, length, mtime, sizes = item
+    try:
+        cache = CoverCache()
+        for size, data in render(cover_data(source, offset, length), sizes).iteritems():
+            cache.put(folder_id, size, data, mtime)
+        return len(sizes)
+    except:
+        app.logger.warn('Problem rendering cover art from ' + source)
+        return 0
+
+class CoverRenderer:
+    """Renders ahead of time the cover art of all folders, at each of the
+    configured sizes, on a pool of processes"""
+
+    def __init__(self, jobs = 1):
+        self.__jobs = max(1, jobs)
+        self.__cache = CoverCache()
+
+    def run(self):
+        """Returns the number of images rendered"""
+
+        sizes = cover_sizes()
+        items = []
+        for folder_id, source, offset, length in session.query(Folder.id, Folder.cover_art, Folder.cover_art_offset, Folder.cover_art_length) \
+                .filter(Folder.cover_art != None, Folder.cover_art != u''):
+            try:
+                mtime = int(os.path.getmtime(source))
+            except OSError:
+                continue
+
+            missing = [ size for size in sizes if not self.__cache.get(folder_id, size, mtime) ]
+            if missing:
+                items.append((folder_id, source, offset, length, mtime, missing))
+
+        pool = multiprocessing.Pool(self.__jobs)
+        try:
+            return sum(pool.imap_unordered(render_cover, items, 8))
+        finally:
+            pool.terminate()
+            pool.join()
@@ -28,10 +28,12 @@ import uuid
 import datetime
 import time
 import mimetypes
+import unicodedata
 import os.path
 
 import sqlamp
 
+import config
 from web import app
 
 database = SQLAlchemy(app)
@@ -43,6 +45,7 @@ Unicode = database.Unicode
 ForeignKey = database.ForeignKey
 func = database.func
 Integer = database.Integer
+Float = database.Float
 Boolean = database.Boolean
 DateTime = database.DateTime
 relationship = database.relationship
@@ -110,12 +113,82 @@ def now():
     return datetime.datetime.now().replace(microsecond = 0)
 
 
+# Letters that don't decompose into a base letter and combining marks
+_UNFOLDED = { ord(u'\xdf'): u'ss', ord(u'\xe6'): u'ae', ord(u'\u0153'): u'oe', ord(u'\xf8'): u'o', ord(u'\u0111'): u'd',
+    ord(u'\u0142'): u'l', ord(u'\xfe'): u'th', ord(u'\xf0'): u'd' }
+
+def name_key(name):
+    """Unaccented, lower case form of a name with its whitespace collapsed,
+    which sorts and compares the way people expect: "Björk" and "bjork"
+    have the same key"""
+
+    if not name:
+        return name
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = u''.join(c for c in name if not unicodedata.combining(c)).translate(_UNFOLDED)
+    return u' '.join(name.split())[:255]
+
+
+# Keeps IN clauses below SQLite's default limit of 999 bound parameters
+IN_CHUNK_SIZE = 500
+
+def chunks(seq, size = IN_CHUNK_SIZE):
+    seq = list(seq)
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
+
+def preload(ent, ids):
+    """Loads the given entities in a single query per chunk so that subsequent
+    many-to-one lazy loads are answered from the session identity map.
+
+    The session only holds weak references, callers have to keep the returned
+    list alive for as long as they rely on the preloaded entities."""
+
+    loaded = []
+    for chunk in chunks(set(filter(None, ids))):
+        loaded += session.query(ent).filter(ent.id.in_(chunk)).all()
+    return loaded
+
+def fetch_annotations(user, ids, starred_ent, rating_ent = None):
+    """Returns (starred, ratings, averages) dicts keyed by entity id for the
+    given user, using a fixed number of queries whatever the number of ids."""
+
+    starred, ratings, averages = {}, {}, {}
+    for chunk in chunks(set(ids)):
+        starred.update(session.query(starred_ent.starred_id, starred_ent.date)
+            .filter(starred_ent.user_id == user.id, starred_ent.starred_id.in_(chunk)))
+        if rating_ent is not None:
+            ratings.update(session.query(rating_ent.rated_id, rating_ent.rating)
+                .filter(rating_ent.user_id == user.id, rating_ent.rated_id.in_(chunk)))
+
+    for chunk in chunks(ratings.keys()):
+        averages.update(session.query(rating_ent.rated_id, func.avg(rating_ent.rating))
+            .filter(rating_ent.rated_id.in_(chunk)).group_by(rating_ent.rated_id))
+
+    return starred, ratings, averages
+
+def annotate(info, eid, annotations):
+    starred, ratings, averages = annotations
+    if eid in starred:
+        info['starred'] = starred[eid].isoformat()
+
+    if eid in ratings:
+        info['userRating'] = ratings[eid]
+        if averages.get(eid):
+            info['averageRating'] = averages[eid]
+
+
 class User(Base, UnicodeMixIn):
 
     id = UUID.gen_id_column()
     name = Column(Unicode(64), unique = True)
     mail = Column(Unicode(255))
     password = Column(BINARY(20))
+    # Hexadecimal password as clients know it, kept for token authentication when it is enabled
+    token_password = Column(Unicode(512), nullable = True)
     admin = Column(Boolean, default = False)
     lastfm_session = Column(Unicode(32), nullable = True)
     lastfm_status = Column(Boolean, default = True) # True: ok/unlinked, False: invalid session
@@ -160,6 +233,14 @@ class Folder(Base, UnicodeMixIn):
     path = Column(Unicode(4096)) # should be unique, but mysql don't like such large columns
     created = Column(DateTime, default = now)
     last_scan = Column(DateTime, default = now)
+    # Image file, or audio file with embedded art, found by the scanner. Empty once a request found none, until
+    # the folder is scanned again.
+    cover_art = Column(Unicode(4096), nullable = True)
+    # Where the embedded picture is stored in the audio file, when it can be read as it is
+    cover_art_offset = Column(Integer, nullable = True)
+    cover_art_length = Column(Integer, nullable = True)
+    # name_key() of the name, set by the scanner
+    name_key = Column(Unicode(255), index = True)
 
     parent_id = Column(ForeignKey('folder.id', ondelete="CASCADE"))
     parent = relationship("Folder", remote_side=[id])
@@ -172,7 +253,7 @@ class Folder(Base, UnicodeMixIn):
     def get_children(self):
         return self.mp.query_children().all()
 
-    def as_subsonic_child(self, user):
+    def as_subsonic_child(self, user, annotations = None):
 
         info = {
             'id': self.id,
@@ -188,24 +269,25 @@ class Folder(Base, UnicodeMixIn):
 
         info['coverArt'] = self.id
 
-        starred = session.query(StarredFolder).get((user.id, self.id))
-        if starred:
-            info['starred'] = starred.date.isoformat()
-
-        rating = session.query(RatingFolder).get((user.id, self.id))
-        if rating:
-            info['userRating'] = rating.rating
-            avgRating = session.query(RatingFolder).filter(RatingFolder.rated_id == self.id).value(func.avg(RatingFolder.rating))
-            if avgRating:
-                info['averageRating'] = avgRating
+        if annotations is None:
+            annotations = fetch_annotations(user, [ self.id ], StarredFolder, RatingFolder)
+        annotate(info, self.id, annotations)
 
         return info
 
+    @staticmethod
+    def as_subsonic_children(folders, user):
+        folders = list(folders)
+        parents = preload(Folder, [ f.parent_id for f in folders ])
+        annotations = fetch_annotations(user, [ f.id for f in folders ], StarredFolder, RatingFolder)
+        return [ f.as_subsonic_child(user, annotations) for f in folders ]
+
 
 class Album(Base, UnicodeMixIn):
 
     id = UUID.gen_id_column()
     name = Column(Unicode(255))
+    name_key = Column(Unicode(255), index = True)
     artist_id = Column(UUID, ForeignKey('artist.id'))
     year = Column(Unicode(32))
 
@@ -239,6 +321,7 @@ class Artist(Base, UnicodeMixIn):
 
     id = UUID.gen_id_column()
     name = Column(Unicode(255), nullable=False)
+    name_key = Column(Unicode(255), index = True)
     albums = relationship(Album, backref = 'artist')
 
     def as_subsonic_artist(self, user):
@@ -262,16 +345,23 @@ class Track(Base, UnicodeMixIn):
     disc = Column(Integer)
     number = Column(Integer)
     title = Column(Unicode(255))
+    title_key = Column(Unicode(255), index = True)
     artist = Column(Unicode(255))
     year = Column(Integer, nullable = True)
     genre = Column(Unicode(255), nullable = True)
     duration = Column(Integer)
+    precise_duration = Column(Float, nullable = True) # optional, in seconds, as read by the scanner
     bitrate = Column(Integer)
 
     path = Column(Unicode(4096)) # should be unique, but mysql don't like such large columns
     created = Column(DateTime, default = now)
     last_modification = Column(Integer)
 
+    # File info recorded by the scanner so serializing a track doesn't hit the filesystem
+    size = Column(Integer, nullable = True)
+    content_type = Column(Unicode(64), nullable = True)
+    _suffix = Column('suffix', Unicode(8), nullable = True)
+
     play_count = Column(Integer, default = 0)
     last_play = Column(DateTime, nullable = True)
 
@@ -281,21 +371,21 @@ class Track(Base, UnicodeMixIn):
     album_id = Column(UUID, ForeignKey('album.id'))
     album = relationship(Album, backref = backref('tracks', cascade="save-update, delete"))
 
-    def as_subsonic_child(self, user):
-        if (os.path.isfile(self.path)):
-            size = os.path.getsize(self.path)
-        else:
-            size = 0
+    def as_subsonic_child(self, user, annotations = None):
+        if self.size is None:
+            # Track scanned before file info was recorded, fill it in lazily
+            self.refresh_file_info()
+
         info = {
             'id': self.id,
-            'parent': self.folder.id,
+            'parent': self.folder_id,
             'isDir': False,
             'title': self.title,
             'album': self.album.name,
             'artist': self.artist,
             'track': self.number,
-            'size': size,
-            'contentType': mimetypes.guess_type(self.path),
+            'size': self.size,
+            'contentType': self.content_type,
             'suffix': self.suffix(),
             'duration': self.duration,
             'bitRate': self.bitrate,
@@ -303,8 +393,8 @@ class Track(Base, UnicodeMixIn):
             'isVideo': False,
             'discNumber': self.disc,
             'created': self.created.isoformat(),
-            'albumId': self.album.id,
-            'artistId': self.album.artist.id,
+            'albumId': self.album_id,
+            'artistId': self.album.artist_id,
             'type': 'music'
         }
 
@@ -314,18 +404,11 @@ class Track(Base, UnicodeMixIn):
         if self.genre:
             info['genre'] = self.genre
 
-        info['coverArt'] = self.folder.id
-
-        starred = session.query(StarredTrack).get((user.id, self.id))
-        if starred:
-            info['starred'] = starred.date.isoformat()
+        info['coverArt'] = self.folder_id
 
-        rating = session.query(RatingTrack).get((user.id, self.id))
-        if rating:
-            info['userRating'] = rating.rating
-            avgRating = session.query(RatingTrack).filter(RatingTrack.rated_id == self.id).value(func.avg(RatingTrack.rating))
-            if avgRating:
-                info['averageRating'] = avgRating
+        if annotations is None:
+            annotations = fetch_annotations(user, [ self.id ], StarredTrack, RatingTrack)
+        annotate(info, self.id, annotations)
 
         if self.suffix() == 'flac':
             info['transcodedContentType'] = 'audio/ogg'
@@ -333,6 +416,17 @@ class Track(Base, UnicodeMixIn):
 
         return info
 
+    @staticmethod
+    def as_subsonic_children(tracks, user):
+        """Serializes a list of tracks with a number of queries that doesn't
+        depend on the length of the list"""
+
+        tracks = list(tracks)
+        folders = preload(Folder, [ t.folder_id for t in tracks ])
+        albums = preload(Album, [ t.album_id for t in tracks ])
+        annotations = fetch_annotations(user, [ t.id for t in tracks ], StarredTrack, RatingTrack)
+        return [ t.as_subsonic_child(user, annotations) for t in tracks ]
+
     def duration_str(self):
         ret = '%02i:%02i' % ((self.duration % 3600) / 60, self.duration % 60)
         if self.duration >= 3600:
@@ -340,7 +434,27 @@ class Track(Base, UnicodeMixIn):
             return ret
 
     def suffix(self):
-        return os.path.splitext(self.path)[1][1:].lower()
+        if self._suffix is None:
+            return os.path.splitext(self.path)[1][1:].lower()
+        return self._suffix
+
+    @staticmethod
+    def file_info(path):
+        """Returns size, content type and suffix of a track file, keyed by
+        column name. A missing file gets a size of 0."""
+
+        suffix = os.path.splitext(path)[1][1:].lower()
+        return {
+            'size': os.path.getsize(path) if os.path.isfile(path) else 0,
+            'content_type': config.get('mimetypes', suffix) or mimetypes.guess_type(path)[0],
+            'suffix': suffix
+        }
+
+    def refresh_file_info(self):
+        info = Track.file_info(self.path)
+        self.size = info['size']
+        self.content_type = info['content_type']
+        self._suffix = info['suffix']
 
     def sort_key(self):
         #return (self.album.artist.name + self.album.name + ("%02i" % self.disc) + ("%02i" % self.number) + self.title).lower()
@@ -0,0 +1,84 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compact JSON writer for the API responses, the JSON counterpart of
+dict2xml_chunks."""
+
+import datetime
+import uuid
+import simplejson
+from simplejson.encoder import encode_basestring_ascii
+
+# Encoding is left to the C encoder, which only sees plain values once _prepare went through the
+# response. Anything unexpected is still written as its unicode string.
+_encoder = simplejson.JSONEncoder(separators = (',', ':'), default = unicode)
+
+_PLAIN = frozenset([ unicode, str, int, long, float, bool, type(None) ])
+
+def _convert(value):
+    t = type(value)
+    if t is dict:
+        return _prepare(value)
+    if t is uuid.UUID:
+        return str(value)
+    if t is list:
+        return map(_convert, value)
+    if t is datetime.datetime or t is datetime.date:
+        return value.isoformat()
+    return value
+
+def _prepare(d):
+    """Copy of a dict with its UUIDs and dates turned into strings, and its
+    empty lists left out as Subsonic clients expect, in a single pass"""
+
+    ret = {}
+    for key, value in d.iteritems():
+        t = type(value)
+        if t is list:
+            if not value:
+                continue
+            value = map(_convert, value)
+        elif t not in _PLAIN:
+            value = _convert(value)
+        ret[key] = value
+    return ret
+
+def _chunks(value, batch):
+    if type(value) is dict:
+        yield '{'
+        for i, (key, item) in enumerate(value.iteritems()):
+            yield (',' if i else '') + encode_basestring_ascii(key) + ':'
+            for chunk in _chunks(item, batch):
+                yield chunk
+        yield '}'
+    elif type(value) is list and len(value) > batch:
+        yield '['
+        for i in xrange(0, len(value), batch):
+            yield (',' if i else '') + _encoder.encode(value[i:i + batch])[1:-1]
+        yield ']'
+    else:
+        yield _encoder.encode(value)
+
+def dict2json_chunks(d, batch = 100):
+    """Yields the JSON document of a dict without any whitespace. Lists
+    longer than batch are written batch items at a time, each chunk being
+    encoded at once."""
+
+    return _chunks(_prepare(d), batch)
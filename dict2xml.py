@@ -43,6 +43,8 @@
 	  </family>
 """
 
+from itertools import izip, repeat
+import re
 from xml.dom.minidom import Text
 
 def dict2xml(d, root_node=None):
@@ -80,3 +82,71 @@ def dict2xml(d, root_node=None):
 
 	return xml
 
+
+# Same escaping as xml.dom.minidom.Text.toxml, most values don't need any
+_ESCAPES    = { u'&': u'&amp;', u'<': u'&lt;', u'>': u'&gt;', u'"': u'&quot;' }
+_ESCAPE_RE  = re.compile(u'[&<>"]')
+_escape_sub = lambda m: _ESCAPES[m.group()]
+
+def escape(value):
+	if not isinstance(value, unicode):
+		value = unicode(value)
+	if _ESCAPE_RE.search(value):
+		return _ESCAPE_RE.sub(_escape_sub, value)
+	return value
+
+def dict2xml_chunks(d, root_node, chunk_size=8192):
+	"""
+	Streaming counterpart of dict2xml, for a dict under a root node. Yields
+	the document in unicode chunks of about chunk_size characters, without
+	recursing nor building it in memory.
+	"""
+
+	out    = []
+	length = 0
+	# Iterators over the (name, value) still to write at each level, and the tag closing that level
+	stack  = [ iter([ (root_node, d) ]) ]
+	closes = [ None ]
+
+	while stack:
+		for name, value in stack[-1]:
+			if isinstance(value, dict):
+				children = []
+				element  = u'<' + name
+				for key, item in value.iteritems():
+					if isinstance(item, (dict, list)):
+						children.append((key, item))
+					else:
+						element += u' ' + key + u'="' + escape(item) + u'"'
+
+				if children:
+					out.append(element + u'>')
+					length += len(element) + 1
+					stack.append(iter(children))
+					closes.append(u'</' + name + u'>')
+					break
+
+				out.append(element + u'/>')
+				length += len(element) + 2
+			elif isinstance(value, list):
+				stack.append(izip(repeat(name), value))
+				closes.append(None)
+				break
+			else:
+				element = u'<' + name + u'>' + escape(value) + u'</' + name + u'>'
+				out.append(element)
+				length += len(element)
+
+			if length >= chunk_size:
+				yield u''.join(out)
+				out    = []
+				length = 0
+		else:
+			stack.pop()
+			close = closes.pop()
+			if close:
+				out.append(close)
+				length += len(close)
+
+	if out:
+		yield u''.join(out)
@@ -45,7 +45,9 @@ def index():
 	stats = {
 		'artists': db.Artist.query.count(),
 		'albums': db.Album.query.count(),
-		'tracks': db.Track.query.count()
+		'tracks': db.Track.query.count(),
+		'auth_hits': UserManager.auth_hits,
+		'auth_misses': UserManager.auth_misses
 	}
 	return render_template('home.html', stats = stats, admin = UserManager.get(session.get('userid'))[1].admin)
 
@@ -0,0 +1,430 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path
+import errno
+import bisect
+import cPickle
+import hashlib
+import re
+import tempfile
+import uuid
+
+from sqlalchemy import exists, text
+from sqlalchemy.exc import DBAPIError
+
+import config
+from web import app
+from db import Track, Folder, Artist, Album, chunks, name_key, session
+
+# Documents of the index, one kind per type of search result
+ARTIST = 'artist'
+ALBUM = 'album'
+TRACK = 'track'
+# Folders with tracks are albums of the folder based API, the other ones artists
+ALBUM_FOLDER = 'album_folder'
+ARTIST_FOLDER = 'artist_folder'
+KINDS = [ ARTIST, ALBUM, TRACK, ALBUM_FOLDER, ARTIST_FOLDER ]
+
+# Every document has these fields, ranked in that order
+FIELDS = [ 'title', 'artist', 'album', 'genre' ]
+WEIGHTS = [ 4, 2, 2, 1 ]
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokens(text):
+    # Unaccented, so that "bjork" finds "Björk"
+    return TOKEN_RE.findall(name_key(text)) if text else []
+
+def versions(kind, ids = None):
+    """Yields the (id, version) of the documents a kind should have, only
+    among some ids if given. Tracks are indexed again when their file
+    changes, the other entities never change what they are indexed on."""
+
+    # Rather than the Folder.tracks backref, which only exists once the mappers are configured
+    has_tracks = exists().where(Track.folder_id == Folder.id)
+    if kind == TRACK:
+        entity, query = Track, session.query(Track.id, Track.last_modification)
+    elif kind == ARTIST:
+        entity, query = Artist, session.query(Artist.id)
+    elif kind == ALBUM:
+        entity, query = Album, session.query(Album.id)
+    elif kind == ALBUM_FOLDER:
+        entity, query = Folder, session.query(Folder.id).filter(has_tracks)
+    else:
+        entity, query = Folder, session.query(Folder.id).filter(~ has_tracks)
+
+    rows = query if ids is None else (row for chunk in chunks(ids) for row in query.filter(entity.id.in_(chunk)))
+    return ((row[0], row[1] if kind == TRACK else 0) for row in rows)
+
+def documents(kind, ids):
+    """Yields the (id, title, artist, album, genre) of the entities of a kind"""
+
+    for chunk in chunks(ids):
+        if kind == TRACK:
+            query = session.query(Track.id, Track.title, Track.artist, Album.name, Track.genre).outerjoin(Album).filter(Track.id.in_(chunk))
+        elif kind == ARTIST:
+            query = session.query(Artist.id, Artist.name).filter(Artist.id.in_(chunk))
+        elif kind == ALBUM:
+            query = session.query(Album.id, Album.name, Artist.name).outerjoin(Artist).filter(Album.id.in_(chunk))
+        else:
+            # Folders are under their artist folder
+            query = ((fid, os.path.basename(path), os.path.basename(os.path.dirname(path)))
+                for fid, path in session.query(Folder.id, Folder.path).filter(Folder.id.in_(chunk)))
+
+        for row in query:
+            yield tuple(row) + (None,) * (len(FIELDS) + 1 - len(row))
+
+class SearchIndex:
+    """Full-text index of the library names and titles. Each backend stores
+    documents of some kind by id along with a version, update() brings the
+    index in line with the database by adding and removing the documents
+    that differ."""
+
+    name = None
+
+    def ready(self):
+        """Whether the index was built, searches can't be answered before"""
+        raise NotImplementedError()
+
+    def search(self, kind, query, offset, count):
+        """Returns the ids of the documents of a kind matching all the words
+        of a query, as word prefixes, best ranked first, along with the total
+        number of matches"""
+        raise NotImplementedError()
+
+    def update(self, changes = None):
+        """Indexes the entities added or changed since the last update and
+        drops the removed ones, returns the number of documents changed.
+
+        changes restricts the update to the ids the caller touched, as a dict
+        of sets by kind: the kinds left out are skipped, the ones mapped to
+        None compared in full. Without it, or while the index isn't built,
+        the whole database is compared to the index."""
+
+        ready = self.ready()
+        if changes is None or not ready:
+            changes = dict.fromkeys(KINDS)
+
+        self._prepare()
+        changed = 0
+        for kind in KINDS:
+            ids = changes.get(kind, ())
+            if ids is None:
+                current = versions(kind)
+                indexed = self._indexed(kind)
+            elif ids:
+                current = versions(kind, ids)
+                indexed = self._indexed(kind, [ eid.hex for eid in ids ])
+            else:
+                continue
+
+            current = dict((eid.hex, (version, eid)) for eid, version in current)
+
+            stale = [ handle for key, (version, handle) in indexed.iteritems() if key not in current or current[key][0] != version ]
+            fresh = [ (eid, version) for key, (version, eid) in current.iteritems() if key not in indexed or indexed[key][0] != version ]
+            if not stale and not fresh:
+                continue
+
+            self._remove(kind, stale)
+            fresh = dict(fresh)
+            self._add(kind, [ (doc[0].hex, fresh[doc[0]]) + doc[1:] for doc in documents(kind, fresh.keys()) ])
+            changed += len(stale) + len(fresh)
+
+        # Nothing written, the builtin index would otherwise be saved again as is
+        if changed or not ready:
+            self._commit()
+        app.logger.debug('Search index updated, %i documents changed', changed)
+        return changed
+
+    def _prepare(self):
+        pass
+
+    def _indexed(self, kind, keys = None):
+        """Returns the documents of a kind as a dict: hex id -> (version, handle),
+        only the ones with the given hex ids if any"""
+        raise NotImplementedError()
+
+    def _remove(self, kind, handles):
+        raise NotImplementedError()
+
+    def _add(self, kind, documents):
+        """Indexes (hex id, version, title, artist, album, genre) documents"""
+        raise NotImplementedError()
+
+    def _commit(self):
+        session.commit()
+
+class SQLiteIndex(SearchIndex):
+    """FTS5 table in the SQLite database itself, ranked with BM25"""
+
+    name = 'sqlite'
+
+    def __init__(self):
+        self.__ready = False
+
+    @staticmethod
+    def available():
+        # FTS5 is an optional SQLite module
+        try:
+            session.execute(text('CREATE VIRTUAL TABLE temp.search_probe USING fts5(probe)'))
+            session.execute(text('DROP TABLE temp.search_probe'))
+            return True
+        except DBAPIError:
+            session.rollback()
+            return False
+
+    def ready(self):
+        if not self.__ready:
+            self.__ready = session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'")).scalar() is not None
+        return self.__ready
+
+    def search(self, kind, query, offset, count):
+        terms = tokens(query)
+        if not terms:
+            return [], 0
+
+        match = ' '.join('"%s"*' % term for term in terms)
+        params = { 'kind': kind, 'match': match, 'offset': offset, 'count': count }
+        total = session.execute(text('SELECT count(*) FROM search_fts WHERE search_fts MATCH :match AND kind = :kind'), params).scalar()
+        rows = session.execute(text('SELECT id FROM search_fts WHERE search_fts MATCH :match AND kind = :kind ' +
+            'ORDER BY bm25(search_fts, 0, 0, 0, %s) LIMIT :count OFFSET :offset' % ', '.join(map(str, WEIGHTS))), params)
+        return [ uuid.UUID(row.id) for row in rows ], total
+
+    def _prepare(self):
+        session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(kind UNINDEXED, id UNINDEXED, " +
+            "version UNINDEXED, title, artist, album, genre, prefix = '1 2 3')"))
+
+    def _indexed(self, kind, keys = None):
+        if keys is None:
+            rows = session.execute(text('SELECT rowid, id, version FROM search_fts WHERE kind = :kind'), { 'kind': kind })
+            return dict((row.id, (row.version, row.rowid)) for row in rows)
+
+        # Looked up by rowid, the other columns of an FTS5 table have no index
+        indexed = {}
+        for chunk in chunks(keys):
+            rows = session.execute(text('SELECT rowid, id, version FROM search_fts WHERE rowid IN (%s)' %
+                ', '.join(str(self.__rowid(kind, key)) for key in chunk)))
+            indexed.update((row.id, (row.version, row.rowid)) for row in rows)
+        return indexed
+
+    def _remove(self, kind, handles):
+        for chunk in chunks(handles):
+            session.execute(text('DELETE FROM search_fts WHERE rowid IN (%s)' % ', '.join(map(str, chunk))))
+
+    def _add(self, kind, documents):
+        if documents:
+            session.execute(text('INSERT INTO search_fts (rowid, kind, id, version, title, artist, album, genre) ' +
+                'VALUES (:rowid, :kind, :id, :version, :title, :artist, :album, :genre)'),
+                # Stored unaccented as the query terms are, the tokenizer doesn't fold "ø" or "ß"
+                [ dict(zip([ 'id', 'version' ] + FIELDS, doc[:2] + tuple(map(name_key, doc[2:]))), kind = kind,
+                    rowid = self.__rowid(kind, doc[0])) for doc in documents ])
+
+    @staticmethod
+    def __rowid(kind, key):
+        # 60 bits of a hash of the kind and id, a folder changing kind gets another rowid
+        return int(hashlib.sha1(kind + key).hexdigest()[:15], 16)
+
+class PostgreSQLIndex(SearchIndex):
+    """tsvector column with a GIN index, fields weighted from A to C"""
+
+    name = 'postgresql'
+    DOCUMENT = " || ".join("setweight(to_tsvector('simple', coalesce(:%s, '')), '%s')" % (field, weight)
+        for field, weight in zip(FIELDS, 'ABBC'))
+
+    def __init__(self):
+        self.__ready = False
+
+    def ready(self):
+        if not self.__ready:
+            self.__ready = session.execute(text("SELECT to_regclass('search_doc')")).scalar() is not None
+        return self.__ready
+
+    def search(self, kind, query, offset, count):
+        terms = tokens(query)
+        if not terms:
+            return [], 0
+
+        params = { 'kind': kind, 'query': ' & '.join(term + ':*' for term in terms), 'offset': offset, 'count': count }
+        where = "FROM search_doc, to_tsquery('simple', :query) query WHERE kind = :kind AND document @@ query"
+        total = session.execute(text('SELECT count(*) ' + where), params).scalar()
+        rows = session.execute(text('SELECT id ' + where + ' ORDER BY ts_rank(document, query) DESC LIMIT :count OFFSET :offset'), params)
+        return [ uuid.UUID(str(row.id)) for row in rows ], total
+
+    def _prepare(self):
+        session.execute(text('CREATE TABLE IF NOT EXISTS search_doc (kind varchar(16) NOT NULL, id uuid NOT NULL, ' +
+            'version integer NOT NULL, document tsvector NOT NULL, PRIMARY KEY (kind, id))'))
+        session.execute(text('CREATE INDEX IF NOT EXISTS search_doc_document ON search_doc USING gin(document)'))
+
+    def _indexed(self, kind, keys = None):
+        if keys is None:
+            rows = session.execute(text('SELECT id, version FROM search_doc WHERE kind = :kind'), { 'kind': kind })
+        else:
+            rows = (row for chunk in chunks(keys) for row in session.execute(text('SELECT id, version FROM search_doc ' +
+                'WHERE kind = :kind AND id = ANY(CAST(:ids AS uuid[]))'), { 'kind': kind, 'ids': chunk }))
+        return dict((uuid.UUID(str(row.id)).hex, (row.version, str(row.id))) for row in rows)
+
+    def _remove(self, kind, handles):
+        for chunk in chunks(handles):
+            session.execute(text('DELETE FROM search_doc WHERE kind = :kind AND id = ANY(CAST(:ids AS uuid[]))'), { 'kind': kind, 'ids': chunk })
+
+    def _add(self, kind, documents):
+        if documents:
+            session.execute(text('INSERT INTO search_doc (kind, id, version, document) ' +
+                'VALUES (:kind, CAST(:id AS uuid), :version, ' + self.DOCUMENT + ')'),
+                # The simple configuration keeps accents, the fields are stored unaccented as the query terms are
+                [ dict(zip([ 'id', 'version' ] + FIELDS, doc[:2] + tuple(map(name_key, doc[2:]))), kind = kind) for doc in documents ])
+
+class BuiltinIndex(SearchIndex):
+    """Inverted index pickled in the cache directory, for databases without
+    full-text search. Each process loads it again when another one saved a
+    newer version."""
+
+    name = 'builtin'
+
+    def __init__(self):
+        cache_dir = config.get('base', 'cache_dir') or os.path.join(tempfile.gettempdir(), 'supysonic')
+        self.__path = os.path.join(cache_dir, 'search_index')
+        self.__mtime = None
+        # kind -> { 'docs': { hex id: version }, 'words': { hex id: tokens }, 'postings': { token: { hex id: weight } },
+        # 'tokens': sorted tokens }
+        self.__kinds = None
+
+    def ready(self):
+        return self.__load()
+
+    def search(self, kind, query, offset, count):
+        terms = tokens(query)
+        if not terms or not self.__load():
+            return [], 0
+
+        index = self.__kinds[kind]
+        postings, words = index['postings'], index['tokens']
+        scores = None
+        for term in terms:
+            # Every token the term is a prefix of, whole words score more
+            matches = {}
+            for i in xrange(bisect.bisect_left(words, term), len(words)):
+                word = words[i]
+                if not word.startswith(term):
+                    break
+                factor = 1.0 if word == term else 0.5
+                for key, weight in postings[word].iteritems():
+                    matches[key] = max(matches.get(key, 0), weight * factor)
+
+            if scores is None:
+                scores = matches
+            else:
+                scores = dict((key, score + matches[key]) for key, score in scores.iteritems() if key in matches)
+            if not scores:
+                return [], 0
+
+        ranked = sorted(scores.iteritems(), key = lambda item: -item[1])
+        return [ uuid.UUID(key) for key, score in ranked[offset:offset + count] ], len(ranked)
+
+    def _prepare(self):
+        if not self.__load():
+            self.__kinds = dict((kind, { 'docs': {}, 'words': {}, 'postings': {}, 'tokens': [] }) for kind in KINDS)
+
+    def _indexed(self, kind, keys = None):
+        docs = self.__kinds[kind]['docs']
+        if keys is None:
+            keys = docs.iterkeys()
+        return dict((key, (docs[key], key)) for key in keys if key in docs)
+
+    def _remove(self, kind, handles):
+        index = self.__kinds[kind]
+        postings = index['postings']
+        for key in handles:
+            for word in index['words'].pop(key, ()):
+                postings[word].pop(key, None)
+                if not postings[word]:
+                    del postings[word]
+            index['docs'].pop(key, None)
+
+    def _add(self, kind, documents):
+        index = self.__kinds[kind]
+        for doc in documents:
+            key, version, fields = doc[0], doc[1], doc[2:]
+            weights = {}
+            for text, weight in zip(fields, WEIGHTS):
+                for word in tokens(text):
+                    weights[word] = weights.get(word, 0) + weight
+
+            for word, weight in weights.iteritems():
+                index['postings'].setdefault(word, {})[key] = weight
+            index['words'][key] = weights.keys()
+            index['docs'][key] = version
+
+    def _commit(self):
+        for index in self.__kinds.itervalues():
+            index['tokens'] = sorted(index['postings'])
+
+        directory = os.path.dirname(self.__path)
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        # Written aside then renamed, other processes never load a partial index
+        fd, tmp = tempfile.mkstemp(dir = directory)
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(self.__kinds, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.__path)
+        self.__mtime = os.path.getmtime(self.__path)
+
+    def __load(self):
+        """Loads the index if it changed on disk, returns whether there is one"""
+
+        try:
+            mtime = os.path.getmtime(self.__path)
+        except OSError:
+            return self.__kinds is not None
+
+        if mtime != self.__mtime:
+            with open(self.__path, 'rb') as f:
+                self.__kinds = cPickle.load(f)
+            self.__mtime = mtime
+        return True
+
+# Picked once per process
+_index = False
+
+def search_index():
+    """Returns the full-text index configured with the search_index setting,
+    None if it is disabled"""
+
+    global _index
+    if _index is not False:
+        return _index
+
+    backend = config.get('base', 'search_index') or 'auto'
+    dialect = session.bind.dialect.name
+    if backend == 'none':
+        _index = None
+    elif backend == 'auto' and dialect == 'postgresql':
+        _index = PostgreSQLIndex()
+    elif backend == 'auto' and dialect == 'sqlite' and SQLiteIndex.available():
+        _index = SQLiteIndex()
+    else:
+        _index = BuiltinIndex()
+    return _index
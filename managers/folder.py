@@ -19,7 +19,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os.path, uuid
-from db import Folder, Artist, session
+from db import Folder, Artist, name_key, session
 
 class FolderManager:
 	SUCCESS = 0
@@ -59,7 +59,7 @@ class FolderManager:
 		if folder:
 			return FolderManager.PATH_EXISTS
 
-		folder = Folder(root = True, path = path)
+		folder = Folder(root = True, path = path, name_key = name_key(os.path.basename(path)))
 		session.add(folder)
 		session.commit()
 
@@ -101,7 +101,7 @@ class FolderManager:
 		if status != FolderManager.SUCCESS:
 			return status
 
-		scanner.scan(folder)
+		scanner.scan(folder, progress_callback)
 		return FolderManager.SUCCESS
 
 	@staticmethod
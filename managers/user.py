@@ -19,8 +19,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import string, random, hashlib
+import time
 import uuid
 
+import config
 from db import User, session
 from web import app
 
@@ -30,6 +32,15 @@ class UserManager:
     NO_SUCH_USER = 2
     NAME_EXISTS = 3
     WRONG_PASS = 4
+    TOKEN_UNSUPPORTED = 5
+
+    # Successful authentications of this process, by user name and password digest: (expiry time, user id).
+    # Token authentications use None as the digest, the salt changing from one request to the other. Users are
+    # loaded by each request and the credentials checked against them, whichever process changed them.
+    __auth_cache = {}
+    AUTH_CACHE_MAX = 1024
+    auth_hits = 0
+    auth_misses = 0
 
     @staticmethod
     def get(uid):
@@ -57,6 +68,7 @@ class UserManager:
         password = UserManager.__decode_password(password)
         crypt = UserManager.__encrypt_password(password)
         user = User(name = name, mail = mail, password = crypt, admin = admin)
+        UserManager.__keep_password(user, password)
         session.add(user)
         session.commit()
 
@@ -68,6 +80,7 @@ class UserManager:
         if status != UserManager.SUCCESS:
             return status
 
+        UserManager.__forget_auth(user)
         session.delete(user)
         session.commit()
 
@@ -76,14 +89,104 @@ class UserManager:
     @staticmethod
     def try_auth(name, password):
         password = UserManager.__decode_password(password)
+        digest = UserManager.__encrypt_password(password)
+        key = (name, digest)
+
+        user = UserManager.__cached_auth(key, lambda user: user.password == digest)
+        if user:
+            return UserManager.SUCCESS, user
+
         user = session.query(User).filter(User.name == name).first()
         if not user:
             return UserManager.NO_SUCH_USER, None
-        elif hashlib.sha1(password).digest() != user.password:
+        elif digest != user.password:
             return UserManager.WRONG_PASS, None
-        else:
+
+        # Users who logged in before token authentication got enabled can use it from now on
+        if UserManager.token_auth_enabled() and user.token_password != UserManager.__token_password(password):
+            UserManager.__keep_password(user, password)
+            session.commit()
+
+        UserManager.__cache_auth(key, user)
+        return UserManager.SUCCESS, user
+
+    @staticmethod
+    def try_token_auth(name, token, salt):
+        """Subsonic token authentication, token being the MD5 of the password followed by salt. Only works for users
+        whose password got kept since token authentication was enabled."""
+
+        if not UserManager.token_auth_enabled():
+            return UserManager.TOKEN_UNSUPPORTED, None
+
+        salt = salt.encode('utf-8')
+        check = lambda user: bool(user.token_password) and \
+            hashlib.md5(user.token_password.decode('hex') + salt).hexdigest() == token.lower()
+        user = UserManager.__cached_auth((name, None), check)
+        if user:
             return UserManager.SUCCESS, user
 
+        user = session.query(User).filter(User.name == name).first()
+        if not user:
+            return UserManager.NO_SUCH_USER, None
+        elif not user.token_password:
+            return UserManager.TOKEN_UNSUPPORTED, None
+        elif not check(user):
+            return UserManager.WRONG_PASS, None
+
+        UserManager.__cache_auth((name, None), user)
+        return UserManager.SUCCESS, user
+
+    @staticmethod
+    def auth_cache_ttl():
+        return int(config.get('base', 'auth_cache_ttl') or 30)
+
+    @staticmethod
+    def token_auth_enabled():
+        return bool(config.get('base', 'token_auth'))
+
+    @staticmethod
+    def __cached_auth(key, check):
+        """Returns the user of a remembered authentication, loaded again so
+        that the request sees its current state, if its credentials still
+        pass check"""
+
+        cached = UserManager.__auth_cache.get(key)
+        if cached and cached[0] > time.time():
+            user = session.query(User).get(cached[1])
+            if user and check(user):
+                UserManager.auth_hits += 1
+                return user
+            # Deleted, or its password changed, by any process
+            UserManager.__auth_cache.pop(key, None)
+
+        UserManager.auth_misses += 1
+        return None
+
+    @staticmethod
+    def __cache_auth(key, user):
+        """Remembers a successful authentication if the cache is enabled"""
+
+        ttl = UserManager.auth_cache_ttl()
+        if not ttl:
+            return
+
+        now = time.time()
+        if len(UserManager.__auth_cache) >= UserManager.AUTH_CACHE_MAX:
+            for k, cached in UserManager.__auth_cache.items():
+                if cached[0] <= now:
+                    UserManager.__auth_cache.pop(k, None)
+            if len(UserManager.__auth_cache) >= UserManager.AUTH_CACHE_MAX:
+                UserManager.__auth_cache.clear()
+
+        UserManager.__auth_cache[key] = (now + ttl, user.id)
+
+    @staticmethod
+    def __forget_auth(user):
+        # Other processes find out on the next hit, the user no longer passing the check
+        for key, cached in UserManager.__auth_cache.items():
+            if cached[1] == user.id:
+                UserManager.__auth_cache.pop(key, None)
+
     @staticmethod
     def change_password(uid, old_pass, new_pass):
         status, user = UserManager.get(uid)
@@ -97,7 +200,9 @@ class UserManager:
             return UserManager.WRONG_PASS
 
         user.password = UserManager.__encrypt_password(new_pass)
+        UserManager.__keep_password(user, new_pass)
         session.commit()
+        UserManager.__forget_auth(user)
         return UserManager.SUCCESS
 
     @staticmethod
@@ -108,7 +213,9 @@ class UserManager:
 
         new_pass = UserManager.__decode_password(new_pass)
         user.password = UserManager.__encrypt_password(new_pass)
+        UserManager.__keep_password(user, new_pass)
         session.commit()
+        UserManager.__forget_auth(user)
         return UserManager.SUCCESS
 
     @staticmethod
@@ -123,6 +230,8 @@ class UserManager:
             return 'There is already a user with that name'
         elif err == UserManager.WRONG_PASS:
             return 'Wrong password'
+        elif err == UserManager.TOKEN_UNSUPPORTED:
+            return 'Token authentication not available for this user'
         else:
             return 'Unkown error'
 
@@ -130,15 +239,25 @@ class UserManager:
     def __encrypt_password(password):
         return hashlib.sha1(password).digest()
 
+    @staticmethod
+    def __token_password(password):
+        if isinstance(password, unicode):
+            password = password.encode('utf-8')
+        return unicode(password.encode('hex'))
+
+    @staticmethod
+    def __keep_password(user, password):
+        # Tokens can only be checked against the password itself, its SHA1 isn't enough
+        if UserManager.token_auth_enabled():
+            user.token_password = UserManager.__token_password(password)
+
     @staticmethod
     def __decode_password(password):
         if not password.startswith('enc:'):
             return password
 
-        enc = password[4:]
-        ret = ''
-        while enc:
-            ret = ret + chr(int(enc[:2], 16))
-            enc = enc[2:]
-
-        return ret
+        try:
+            return password[4:].decode('hex')
+        except TypeError:
+            # Odd length or not hexadecimal, it won't match anything
+            return password
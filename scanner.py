@@ -17,34 +17,271 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-
 import os, os.path
 import time
+import uuid
 import datetime
+import itertools
+import collections
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import hashlib
+import cPickle
+import stat
+import struct
+import resource
+import tempfile
 from mediafile import MediaFile
 import config
+import covers
+from fulltext import search_index, ARTIST, ALBUM, TRACK, ALBUM_FOLDER, ARTIST_FOLDER
 import math
 import sys, traceback
 from web import app
 
-from db import Track, Folder, Artist, Album, Playlist, session
+from sqlalchemy import bindparam, select
+
+from db import Track, Folder, Artist, Album, StarredTrack, RatingTrack, StarredAlbum, StarredArtist, User
+from db import playlist_track_assoc, chunks, name_key, session
+
+TAGS = [ 'disc', 'track', 'title', 'year', 'genre', 'artist', 'albumartist', 'album', 'bitrate', 'length' ]
+
+def read_tags(item):
+    """Reads the tags of a file. Runs in the scanner worker processes, so it
+    only deals with plain values and doesn't touch the database."""
+
+    path, mtime = item
+    try:
+        mf = MediaFile(path)
+        tags = dict((tag, getattr(mf, tag)) for tag in TAGS)
+        try:
+            # Only whether there is some and where, the image itself isn't needed
+            tags['art'] = (covers.art_location(path) or True) if mf.art else False
+        except:
+            tags['art'] = False
+        return path, mtime, tags
+    except:
+        return path, mtime, traceback.format_exc()
+
+def missing_files(item):
+    """Returns the paths and ids of the tracks of a directory whose file is gone. Lists
+    the directory once rather than checking each file."""
+
+    directory, tracks = item
+    try:
+        names = set(os.listdir(directory))
+    except OSError:
+        names = set()
+    return [ (os.path.join(directory, name), tid) for name, tid in tracks.iteritems() if name not in names ]
+
+def track_values(path, curmtime, tags):
+    """Maps the tags read from a file to Track column values"""
+
+    values = {
+        'disc': tags['disc'],
+        'number': tags['track'],
+        'title': tags['title'],
+        'title_key': name_key(tags['title']),
+        'year': tags['year'],
+        'genre': tags['genre'],
+        'artist': tags['artist'],
+        'bitrate': tags['bitrate']/1000,
+        'duration': tags['length'],
+        'precise_duration': tags['length'],
+        'last_modification': curmtime,
+        'created': datetime.datetime.fromtimestamp(curmtime)
+    }
+    values.update(Track.file_info(path))
+    return values
+
+def album_artist(path, tags):
+    albumartist = tags['albumartist']
+    if (albumartist == u''):
+        # Use folder name two levels up if no albumartist tag found
+        # Assumes structure main -> artist -> album -> song.file
+        # That way the songs in compilations will show up in the same album
+        albumartist = os.path.basename(os.path.dirname(os.path.dirname(path)))
+    return albumartist.rstrip()
+
+class DirectoryIndex:
+    """Persisted signatures (mtime, entry count, digest of the entry names
+    and subdirectories) of the directories of a root folder.
+
+    A directory whose signature didn't change since the previous scan isn't
+    listed again, its subdirectories are taken from the index, so walking an
+    unchanged tree costs a single stat per directory.
+
+    A changed directory is only recorded once done() is called for it, that
+    is once its files are committed. checkpoint() saves what is done so far,
+    an interrupted scan then resumes past those directories."""
+
+    # Directories modified that close to their listing may have changed
+    # within the filesystem timestamp resolution, they are listed again
+    MTIME_SLACK = 2
+
+    def __init__(self, root_folder):
+        cache_dir = config.get('base', 'cache_dir') or os.path.join(tempfile.gettempdir(), 'supysonic')
+        self.__path = os.path.join(cache_dir, 'scan_index', str(root_folder.id))
+        self.__entries = {}
+        self.__listed = {}
+        self.__seen = set()
+        # Both the walker thread and the scanner update the entries
+        self.__lock = threading.Lock()
+
+        # Progress of an interrupted scan, None if the previous one completed
+        self.progress = None
+
+        if os.path.exists(self.__path):
+            try:
+                with open(self.__path, 'rb') as f:
+                    self.__entries = cPickle.load(f)
+                if os.path.exists(self.__path + '.progress'):
+                    with open(self.__path + '.progress', 'rb') as f:
+                        self.progress = cPickle.load(f)
+            except:
+                app.logger.warn('Invalid scan index %s, ignoring it', self.__path)
 
-class Scanner:
-    def __init__(self, session):
-        app.logger.debug('Loading tracks')
-        self.__tracks  = session.query(Track.path, Track.id).all()
-        self.__tracks = {x.path: x.id for x in self.__tracks}
+    def walk(self, top):
+        """Yields (directory, file names) for the directories that changed,
+        or are new, since the index was last saved"""
 
-        app.logger.debug('Loading artists')
-        self.__artists = session.query(Artist).all()
-        self.__artists = {x.name.lower(): x for x in self.__artists}
+        stack = [ top ]
+        while stack:
+            path = stack.pop()
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            self.__seen.add(path)
 
-        app.logger.debug('Loading folders')
-        self.__folders = session.query(Folder).all()
-        self.__folders = {x.path: x for x in self.__folders}
+            entry = self.__entries.get(path)
+            if entry and entry[0] == mtime and mtime < entry[4] - self.MTIME_SLACK:
+                stack.extend(os.path.join(path, d) for d in entry[3])
+                continue
+
+            listed_at = time.time()
+            try:
+                names = os.listdir(path)
+            except OSError:
+                continue
+
+            subdirs, files = [], []
+            for n in names:
+                try:
+                    # lstat so that symlinked directories aren't followed, as with os.walk
+                    is_dir = stat.S_ISDIR(os.lstat(os.path.join(path, n)).st_mode)
+                except OSError:
+                    continue
+                (subdirs if is_dir else files).append(n)
+            digest = hashlib.md5('\0'.join(sorted(n.encode('utf-8') if isinstance(n, unicode) else n for n in names))).digest()
+
+            new_entry = (mtime, len(names), digest, subdirs, listed_at)
+            stack.extend(os.path.join(path, d) for d in subdirs)
+
+            with self.__lock:
+                if entry and entry[0:3] == new_entry[0:3]:
+                    self.__entries[path] = new_entry
+                    continue
+                self.__listed[path] = new_entry
+
+            yield path, files
+
+    def done(self, path):
+        """Records a directory yielded by walk() as scanned"""
+
+        with self.__lock:
+            self.__entries[path] = self.__listed.pop(path)
+
+    def checkpoint(self, progress):
+        """Saves the directories done so far along with some progress
+        information, made available by the progress attribute when the scan
+        is resumed"""
+
+        with self.__lock:
+            entries = dict(self.__entries)
+        self.__write(entries)
+        self.__dump(progress, self.__path + '.progress')
+
+    def save(self, top):
+        with self.__lock:
+            self.__entries.update(self.__listed)
+            self.__listed.clear()
+
+            # Forget the directories that disappeared
+            prefix = top.rstrip(os.sep) + os.sep
+            for path in self.__entries.keys():
+                if (path == top or path.startswith(prefix)) and path not in self.__seen:
+                    del self.__entries[path]
+
+        self.__write(self.__entries)
+        if os.path.exists(self.__path + '.progress'):
+            os.remove(self.__path + '.progress')
+        self.progress = None
 
-        app.logger.debug('Loading playlists')
-        self.__playlists = session.query(Playlist).all()
+    def __write(self, entries):
+        if not os.path.exists(os.path.dirname(self.__path)):
+            os.makedirs(os.path.dirname(self.__path))
+        self.__dump(entries, self.__path)
+
+    def __dump(self, obj, path):
+        with open(path + '.tmp', 'wb') as f:
+            cPickle.dump(obj, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+class PathIndex:
+    """Compact path -> (id, integer) map.
+
+    Keys are 8 bytes of the path MD5 and values the 16 bytes of the id plus a
+    packed integer, several times smaller than unicode paths mapped to UUID
+    objects in tuples. Paths can't be enumerated back."""
+
+    def __init__(self):
+        self.__entries = {}
+
+    @staticmethod
+    def __key(path):
+        return hashlib.md5(path.encode('utf-8')).digest()[:8]
+
+    def set(self, path, eid, value = None):
+        self.__entries[self.__key(path)] = eid.bytes + struct.pack('<q', -1 if value is None else value)
+
+    def get(self, path):
+        packed = self.__entries.get(self.__key(path))
+        if packed is None:
+            return None
+
+        value = struct.unpack('<q', packed[16:])[0]
+        return uuid.UUID(bytes = packed[:16]), None if value == -1 else value
+
+    def pop(self, path):
+        ret = self.get(path)
+        self.__entries.pop(self.__key(path), None)
+        return ret
+
+    def __contains__(self, path):
+        return self.__key(path) in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
+
+class Scanner:
+    # Checking files existence is mostly waiting on the filesystem, network mounts in particular
+    PRUNE_THREADS = 8
+    # Minimum number of seconds between two checkpoints of a scan
+    CHECKPOINT_INTERVAL = 30
+    # Past that many changed entities of a kind, the search index compares all of them rather than keeping the ids
+    SEARCH_CHANGES_LIMIT = 50000
+
+    def __init__(self, session, jobs = 1, bulk = False):
+        self.__bulk = bulk
+        self.__fill_keys()
+        self.__load_artists()
+
+        # Tracks and folders are loaded per root folder, see __use_root
+        self.__root_id = None
+        self.__tracks = PathIndex()
+        self.__folders = PathIndex()
 
         self.__added_artists = 0
         self.__added_albums  = 0
@@ -52,178 +289,531 @@ class Scanner:
         self.__deleted_artists = 0
         self.__deleted_albums  = 0
         self.__deleted_tracks  = 0
+        self.__resumed_directories = 0
+        self.__resumed_files = 0
+
+        self.__filetypes = tuple(x.lower() for x in (config.get('base', 'filetypes') or '').split(',') if x)
 
         extensions = config.get('base', 'scanner_extensions')
         self.__extensions = map(str.lower, extensions.split()) if extensions else None
 
-    def scan(self, root_folder):
+        self.__jobs = max(1, jobs)
+        self.__new_artists = []
+        self.__new_albums = []
+        self.__new_tracks = []
+        self.__updated_tracks = []
+        self.__batch_size = int(config.get('base', 'scanner_batch_size') or 500)
+        self.__search = search_index()
+        # Ids of the entities to index again, by kind, see __changed
+        self.__search_changes = {}
+
+    def scan(self, root_folder, progress_callback = None):
         print "scanning", root_folder.path
-        valid = [x.lower() for x in config.get('base','filetypes').split(',')]
-        valid = tuple(valid)
+        valid = self.__filetypes
         print "valid filetypes: ",valid
 
-        for root, subfolders, files in os.walk(root_folder.path, topdown=False):
+        self.__use_root(root_folder)
+
+        # Directory walker -> tag reader processes -> this process, the only one writing to the database
+        index = DirectoryIndex(root_folder)
+        progress = index.progress or { 'directories': 0, 'files': 0 }
+        if index.progress:
+            app.logger.info('Resuming interrupted scan of %s, skipping %i directories (%i files) already done',
+                root_folder.path, progress['directories'], progress['files'])
+            self.__resumed_directories += progress['directories']
+            self.__resumed_files += progress['files']
+
+        # A directory is done once all the files queued by the walker are processed
+        listed = collections.deque()
+        queued = collections.defaultdict(int)
+        processed = collections.defaultdict(int)
+        waiting = []
+        # Cover art candidate per directory: best image file, otherwise first track with embedded art
+        candidates = {}
+        files = self.__walk(root_folder.path, valid, index, listed, queued, candidates)
+
+        pool = None
+        if self.__jobs > 1:
+            pool = multiprocessing.Pool(self.__jobs)
+            results = pool.imap_unordered(read_tags, files, 16)
+        else:
+            results = itertools.imap(read_tags, files)
+
+        scanned = 0
+        last_checkpoint = time.time()
+        try:
+            for path, mtime, tags in results:
+                self.__add_file(path, mtime, tags, root_folder)
+                processed[os.path.dirname(path)] += 1
+                if isinstance(tags, dict) and tags['art']:
+                    location = tags['art'] if isinstance(tags['art'], tuple) else None
+                    candidates.setdefault(os.path.dirname(path), (path, location))
+
+                scanned += 1
+                if scanned % self.__batch_size == 0:
+                    done = self.__finish_directories(root_folder, listed, waiting, queued, processed, candidates)
+                    self.__commit()
+                    for d in done:
+                        index.done(d)
+                    progress['directories'] += len(done)
+                    progress['files'] += self.__batch_size
+
+                    if time.time() - last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                        index.checkpoint(progress)
+                        last_checkpoint = time.time()
+
+                    app.logger.info('%i files scanned, %i tracks added', scanned, self.__added_tracks)
+                    if progress_callback:
+                        progress_callback(scanned, self.__added_tracks)
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        self.__finish_directories(root_folder, listed, waiting, queued, processed, candidates)
+        root_folder.last_scan = datetime.datetime.now()
+        self.__commit()
+        index.save(root_folder.path)
+        self.__update_search()
+        if progress_callback:
+            progress_callback(scanned, self.__added_tracks)
+        app.logger.info('Scan of %s done, peak memory usage: %i MiB', root_folder.path, self.peak_memory())
+
+    def __finish_directories(self, root_folder, listed, waiting, queued, processed, candidates):
+        """Returns the directories completely listed by the walker whose files
+        were all processed, marks their folder as scanned and records its
+        cover art"""
+
+        while listed:
+            waiting.append(listed.popleft())
+
+        now = datetime.datetime.now()
+        done = [ path for path in waiting if processed.get(path, 0) == queued.get(path, 0) ]
+        for path in done:
+            candidate = candidates.pop(path, None)
+            # Directories without any track don't get a folder
+            folder = self.__find_folder(path, root_folder, create = False)
+            if folder:
+                folder.last_scan = now
+                self.__set_cover(folder, candidate)
+            processed.pop(path, None)
+            queued.pop(path, None)
+
+        if done:
+            waiting[:] = [ path for path in waiting if path in queued ]
+        return done
+
+    def __set_cover(self, folder, candidate):
+        # Images win over embedded art. Tracks whose tags weren't read again may still have some,
+        # a track read again may have had its picture moved. Folders without any candidate are looked
+        # at again by the next request, even if a previous one found nothing.
+        path, location = candidate or (None, None)
+        if not (path and covers.is_image(os.path.basename(path))) and path != folder.cover_art \
+                and folder.cover_art and os.path.exists(folder.cover_art):
+            return
+
+        folder.cover_art = path
+        folder.cover_art_offset, folder.cover_art_length = location or (None, None)
+
+    def peak_memory(self):
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def __use_root(self, root_folder):
+        """Loads the tracks and folders of a root folder, dropping those of the
+        previously used one"""
+
+        if self.__root_id == root_folder.id:
+            return
+
+        self.__commit()
+        self.__tracks = PathIndex()
+        self.__folders = PathIndex()
+        prefix = root_folder.path.rstrip(os.sep) + os.sep
 
-            if root in self.__folders:
-                folder = self.__folders[root]
-                mod_time = datetime.datetime.fromtimestamp(os.path.getmtime(folder.path))
-                app.logger.debug('mtime: %s , last_scan: %s', mod_time, folder.last_scan)
-                if mod_time < folder.last_scan:
-                    app.logger.debug('Folder not modified, skipping files')
-                    continue
-                folder.last_scan = datetime.datetime.now()
+        app.logger.debug('Loading tracks')
+        for x in session.query(Track.path, Track.id, Track.last_modification, Track.size).filter(Track.path.like(prefix + '%')).yield_per(1000):
+            # Tracks without recorded file info get read again
+            self.__tracks.set(x.path, x.id, x.last_modification if x.size is not None else None)
+
+        app.logger.debug('Loading folders')
+        self.__folders.set(root_folder.path, root_folder.id)
+        for x in session.query(Folder.path, Folder.id).filter(Folder.path.like(prefix + '%')).yield_per(1000):
+            self.__folders.set(x.path, x.id)
+
+        self.__root_id = root_folder.id
+
+    def __fill_keys(self):
+        """Sets the name keys of the rows stored before they existed"""
+
+        folder_key = lambda path: name_key(os.path.basename(path))
+        filled = 0
+        for ent, column, key, make_key in ((Artist, 'name', 'name_key', name_key), (Album, 'name', 'name_key', name_key),
+                (Track, 'title', 'title_key', name_key), (Folder, 'path', 'name_key', folder_key)):
+            table = ent.__table__
+            rows = [ { '_id': x[0], key: make_key(x[1]) }
+                for x in session.query(table.c.id, table.c[column]).filter(table.c[key] == None, table.c[column] != None) ]
+            for chunk in chunks(rows, 1000):
+                session.execute(table.update().where(table.c.id == bindparam('_id')), chunk)
+            filled += len(rows)
+
+        if filled:
+            session.commit()
+            app.logger.info('Set the name keys of %i rows', filled)
+
+    def __load_artists(self):
+        # Only ids are kept, the ORM mode loads the entities when needed. Artists are told apart by
+        # their name key, whatever the case and accents of the name.
+        app.logger.debug('Loading artists')
+        self.__artists = {x.name_key: x.id for x in session.query(Artist.name_key, Artist.id)}
+        if self.__bulk:
+            self.__albums = {(x.artist_id, x.name): x.id for x in session.query(Album.artist_id, Album.name, Album.id)}
+        else:
+            self.__albums = {}
+
+    def accepts(self, path):
+        return path.lower().endswith(self.__filetypes)
+
+    def scan_file(self, path, root_folder):
+        """Scans a single file, regardless of its parent directory state.
+        Changes are only written by commit()."""
+
+        try:
+            mtime = int(math.floor(os.path.getmtime(path)))
+        except OSError:
+            app.logger.error('Problem reading file: ' + path)
+            return
+
+        self.__use_root(root_folder)
+        known = self.__tracks.get(path)
+        if known and known[1] is not None and mtime <= known[1]:
+            return
+
+        self.__add_file(*read_tags((path, mtime)), root_folder = root_folder)
+
+    def remove_file(self, path, root_folder):
+        """Removes the track of a file that no longer exists, along with its
+        album and artist if they end up empty"""
+
+        self.__use_root(root_folder)
+        if path not in self.__tracks:
+            return
+
+        track = session.query(Track).get(self.__tracks.pop(path)[0])
+        if not track:
+            return
+
+        album = track.album
+        self.__changed(track.id, TRACK)
+        self.__changed(track.folder_id, ALBUM_FOLDER, ARTIST_FOLDER)
+        self.__remove_track(track)
+        if album.tracks:
+            return
+
+        artist = album.artist
+        artist.albums.remove(album)
+        session.delete(album)
+        self.__deleted_albums += 1
+        self.__changed(album.id, ALBUM)
+        self.__albums.pop((artist.id if self.__bulk else artist.name_key, album.name), None)
+        if not artist.albums:
+            session.delete(artist)
+            self.__deleted_artists += 1
+            self.__changed(artist.id, ARTIST)
+            self.__artists.pop(artist.name_key, None)
+
+    def remove_directory(self, path, root_folder):
+        prefix = path.rstrip(os.sep) + os.sep
+        for track_path, in session.query(Track.path).filter(Track.path.like(prefix + '%')).all():
+            if track_path.startswith(prefix):
+                self.remove_file(track_path, root_folder)
+
+    def commit(self):
+        self.__commit()
+        self.__update_search()
+
+    def __add_file(self, path, mtime, tags, root_folder):
+        if not isinstance(tags, dict):
+            app.logger.error('Problem reading file: ' + path)
+            app.logger.error(tags)
+            return
+
+        try:
+            folder = self.__find_folder(os.path.dirname(path), root_folder)
+            if self.__bulk:
+                self.__queue_file(path, mtime, tags, folder)
             else:
-                app.logger.debug('Adding folder: ' + root)
-                folder = Folder(path = root, parent = root_folder)
-                folder.created = datetime.datetime.fromtimestamp(os.path.getctime(root))
+                self.__store_file(path, mtime, tags, folder)
+        except:
+            app.logger.error('Problem adding file: ' + path)
+            app.logger.error(traceback.format_exc())
+
+    def __walk(self, root_path, valid, index, listed, queued, candidates):
+        """Yields the (path, mtime) of the files that need their tags read.
+        Runs in the pool feeder thread, so it doesn't touch the database.
 
-                self.__folders[root] = folder
+        The number of files yielded per directory is counted in queued, and
+        the directory added to listed once all its files are yielded. Cover
+        images are recorded in candidates."""
+
+        for root, files in index.walk(root_path):
+            image = covers.best_image(files)
+            if image:
+                candidates[root] = (os.path.join(root, image), None)
 
-            #TODO: only scan files if folder mtime changed, but is it windows compat?
-            # need to see how this works on ntfs-3g
             for f in files:
-                if f.lower().endswith(valid):
-                    try:
-                        path = os.path.join(root, f)
-                        scanned_file = self.__scan_file(path)
+                if not f.lower().endswith(valid):
+                    continue
 
-                        if(scanned_file):
-                            scanned_file.folder = folder
-                            session.add(scanned_file)
-                            session.flush()
+                path = os.path.join(root, f)
+                try:
+                    curmtime = int(math.floor(os.path.getmtime(path)))
+                except OSError:
+                    app.logger.error('Problem reading file: ' + path)
+                    continue
 
-                    except:
-                        app.logger.error('Problem adding file: ' + os.path.join(root,f))
-                        app.logger.error(traceback.print_exc())
-                        pass
+                known = self.__tracks.get(path)
+                if known and known[1] is not None and curmtime <= known[1]:
+                    app.logger.debug('\tFile not modified: ' + path)
+                    continue
 
-        root_folder.last_scan = datetime.datetime.now()
-        session.flush()
-        session.commit()
+                queued[root] += 1
+                yield path, curmtime
 
+            listed.append(root)
 
-    def __scan_file(self, path):
-        curmtime = int(math.floor(os.path.getmtime(path)))
+    def __find_folder(self, path, root_folder, create = True):
+        known = self.__folders.get(path)
+        folder = session.query(Folder).get(known[0]) if known else None
+        if folder or not create:
+            return folder
 
-        if path in self.__tracks:
-            tr = session.query(Track).get(self.__tracks[path])
+        app.logger.debug('Adding folder: ' + path)
+        folder = Folder(id = uuid.uuid4(), path = path, name_key = name_key(os.path.basename(path)), parent = root_folder)
+        folder.created = datetime.datetime.fromtimestamp(os.path.getctime(path))
+        # Flushed on its own: sqlamp works out the materialized path of a folder from the siblings already
+        # stored, folders inserted together would all get the same one
+        session.add(folder)
+        session.flush()
+        self.__folders.set(path, folder.id)
+        self.__changed(folder.id, ALBUM_FOLDER, ARTIST_FOLDER)
+        return folder
 
-            if curmtime <= tr.last_modification:
-                app.logger.debug('\tFile not modified: ' + path)
-                return tr
+    def __store_file(self, path, curmtime, tags, folder):
+        if path in self.__tracks:
+            tr = session.query(Track).get(self.__tracks.get(path)[0])
+            app.logger.debug('\tFile modified, updating tag: ' + path)
+        else:
+            tr = None
 
-            app.logger.debug('\tFile modified, updating tag')
-            app.logger.debug('\tcurmtime %s / last_mod %s', curmtime, tr.last_modification)
-            app.logger.debug('\t\t%s Seconds Newer\n\t\t', str(curmtime - tr.last_modification))
+        if tr is None:
+            app.logger.debug('Adding File: ' + path)
+            tr = Track(id = uuid.uuid4(), path = path, folder = folder)
+            session.add(tr)
+            self.__tracks.set(path, tr.id, curmtime)
+            self.__added_tracks += 1
+            self.__changed(folder.id, ALBUM_FOLDER, ARTIST_FOLDER)
+        self.__changed(tr.id, TRACK)
 
-            try:
-                mf = MediaFile(path)
-            except:
-                app.logger.error('Problem reading file: ' + path)
-                app.logger.error(traceback.print_exc())
-                return tr
+        values = track_values(path, curmtime, tags)
+        values['_suffix'] = values.pop('suffix')
+        for key, value in values.iteritems():
+            setattr(tr, key, value)
 
-        else:
-            app.logger.debug('Scanning File: ' + path + '\n\tReading tag')
+        # album year is the same as year of first track found from album, might be inaccurate
+        tr.album    = self.__find_album(album_artist(path, tags), tags['album'], tr.year)
 
-            try:
-                mf = MediaFile(path)
-            except:
-                app.logger.error('Problem reading file: ' + path)
-                app.logger.error(traceback.print_exc())
-                return False
+    def __queue_file(self, path, curmtime, tags, folder):
+        """Bulk mode counterpart of __store_file, the track row is written by __write_queued"""
 
-            tr = Track(path = path)
+        values = track_values(path, curmtime, tags)
+        values['album_id'] = self.__find_album_id(album_artist(path, tags), tags['album'], values['year'])
+        values['folder_id'] = folder.id
 
+        if path in self.__tracks:
+            values['_id'] = self.__tracks.get(path)[0]
+            self.__updated_tracks.append(values)
+            self.__changed(values['_id'], TRACK)
+        else:
+            values.update(id = uuid.uuid4(), path = path, play_count = 0)
+            self.__new_tracks.append(values)
+            self.__tracks.set(path, values['id'], curmtime)
             self.__added_tracks += 1
+            self.__changed(values['id'], TRACK)
+            self.__changed(folder.id, ALBUM_FOLDER, ARTIST_FOLDER)
+
+    def __find_album_id(self, artist, album, yr):
+        key = name_key(artist)
+        if key not in self.__artists:
+            self.__artists[key] = uuid.uuid4()
+            self.__new_artists.append({ 'id': self.__artists[key], 'name': artist, 'name_key': key })
+            self.__added_artists += 1
+            self.__changed(self.__artists[key], ARTIST)
 
-        tr.last_modification = curmtime
+        artist_id = self.__artists[key]
+        if (artist_id, album) not in self.__albums:
+            self.__albums[(artist_id, album)] = uuid.uuid4()
+            self.__new_albums.append({ 'id': self.__albums[(artist_id, album)], 'name': album, 'name_key': name_key(album),
+                'artist_id': artist_id, 'year': yr })
+            self.__added_albums += 1
+            self.__changed(self.__albums[(artist_id, album)], ALBUM)
 
-        # read in file tags
-        tr.disc = getattr(mf, 'disc')
-        tr.number = getattr(mf, 'track')
-        tr.title = getattr(mf, 'title')
-        tr.year = getattr(mf, 'year')
-        tr.genre = getattr(mf, 'genre')
-        tr.artist = getattr(mf, 'artist')
-        tr.bitrate  = getattr(mf, 'bitrate')/1000
-        tr.duration = getattr(mf, 'length')
+        return self.__albums[(artist_id, album)]
 
-        albumartist = getattr(mf, 'albumartist')
-        if (albumartist == u''):
-            # Use folder name two levels up if no albumartist tag found
-            # Assumes structure main -> artist -> album -> song.file
-            # That way the songs in compilations will show up in the same album
-            albumartist = os.path.basename(os.path.dirname(os.path.dirname(path)))
+    def __write_queued(self):
+        session.flush()
 
-        tr.created = datetime.datetime.fromtimestamp(curmtime)
+        table = Track.__table__
+        for query, rows in ((Artist.__table__.insert(), self.__new_artists), (Album.__table__.insert(), self.__new_albums),
+                (table.insert(), self.__new_tracks), (table.update().where(table.c.id == bindparam('_id')), self.__updated_tracks)):
+            if rows:
+                session.execute(query, rows)
+                del rows[:]
 
-        # album year is the same as year of first track found from album, might be inaccurate
-        tr.album    = self.__find_album(albumartist, getattr(mf, 'album'), tr.year)
+    def __commit(self):
+        if self.__bulk:
+            self.__write_queued()
+        session.commit()
 
-        return tr
+        # Only keep ids, the entities get loaded again if needed
+        for cache in (self.__artists, self.__albums):
+            for key, value in cache.items():
+                if isinstance(value, (Artist, Album)):
+                    cache[key] = value.id
 
     def __find_album(self, artist, album, yr):
-        # TODO : DB specific issues with single column name primary key
-        #		for instance, case sensitivity and trailing spaces
-        artist = artist.rstrip()
-
-        if artist.lower() in self.__artists:
+        # Looked up by name key rather than by name, the database collation doesn't matter
+        artist_key = name_key(artist)
+        if artist_key in self.__artists:
             app.logger.debug('Artist already exists')
-            ar = self.__artists[artist.lower()]
+            ar = self.__artists[artist_key]
+            if not isinstance(ar, Artist):
+                ar = self.__artists[artist_key] = session.query(Artist).get(ar)
         else:
             #Flair!
             sys.stdout.write('\033[K')
             sys.stdout.write('%s\r' % artist.encode('utf-8'))
             sys.stdout.flush()
-            ar = Artist(name = artist)
-            self.__artists[artist.lower()] = ar
+            ar = Artist(id = uuid.uuid4(), name = artist, name_key = artist_key)
+            self.__artists[artist_key] = ar
             self.__added_artists += 1
+            self.__changed(ar.id, ARTIST)
+
+        key = (artist_key, album)
+        if key not in self.__albums:
+            # Looking through the artist albums once, then remembering them
+            al = {a.name: a for a in ar.albums}
+            if album in al:
+                self.__albums[key] = al[album]
+            else:
+                self.__added_albums += 1
+                self.__albums[key] = Album(id = uuid.uuid4(), name = album, name_key = name_key(album), artist = ar, year = yr)
+                self.__changed(self.__albums[key].id, ALBUM)
+        elif not isinstance(self.__albums[key], Album):
+            self.__albums[key] = session.query(Album).get(self.__albums[key])
 
-        al = {a.name: a for a in ar.albums}
-        if album in al:
-            return al[album]
-        else:
-            self.__added_albums += 1
-            album = Album(name = album, artist = ar, year = yr)
-            return album
+        return self.__albums[key]
 
     def prune(self, folder):
+        self.__use_root(folder)
+
+        prefix = folder.path.rstrip(os.sep) + os.sep
+        directories = {}
+        for path, tid in session.query(Track.path, Track.id).filter(Track.path.like(prefix + '%')).yield_per(1000):
+            if path.startswith(prefix):
+                directories.setdefault(os.path.dirname(path), {})[os.path.basename(path)] = tid
+
+        app.logger.debug('Checking %i directories for missing files...', len(directories))
+        pool = ThreadPool(self.PRUNE_THREADS)
+        try:
+            missing = [ item for items in pool.imap_unordered(missing_files, directories.iteritems()) for item in items ]
+        finally:
+            pool.terminate()
+
+        track = Track.__table__
+        album = Album.__table__
+        artist = Artist.__table__
+        assoc = playlist_track_assoc
+
+        for path, tid in missing:
+            self.__tracks.pop(path)
+        missing = [ tid for path, tid in missing ]
+
+        for chunk in chunks(missing):
+            for fid, in session.execute(select([ track.c.folder_id ]).where(track.c.id.in_(chunk)).distinct()):
+                self.__changed(fid, ALBUM_FOLDER, ARTIST_FOLDER)
+            for tid in chunk:
+                self.__changed(tid, TRACK)
+            session.execute(StarredTrack.__table__.delete().where(StarredTrack.__table__.c.starred_id.in_(chunk)))
+            session.execute(RatingTrack.__table__.delete().where(RatingTrack.__table__.c.rated_id.in_(chunk)))
+            session.execute(User.__table__.update().where(User.__table__.c.last_play_id.in_(chunk)).values(last_play_id = None))
+            session.execute(track.delete().where(track.c.id.in_(chunk)))
+        self.__deleted_tracks += len(missing)
+
+        # Whatever removed them, clean up entries pointing to tracks that no longer exist
+        session.execute(assoc.delete().where(~assoc.c.track_id.in_(select([ track.c.id ]))))
+
+        app.logger.debug('Removing empty albums...')
+        used_albums = select([ track.c.album_id ]).where(track.c.album_id != None)
+        session.execute(StarredAlbum.__table__.delete().where(~StarredAlbum.__table__.c.starred_id.in_(used_albums)))
+        self.__deleted_albums += self.__delete_unused(album, used_albums, ALBUM)
+
+        app.logger.debug('Removing artists with no albums...')
+        used_artists = select([ album.c.artist_id ]).where(album.c.artist_id != None)
+        session.execute(StarredArtist.__table__.delete().where(~StarredArtist.__table__.c.starred_id.in_(used_artists)))
+        self.__deleted_artists += self.__delete_unused(artist, used_artists, ARTIST)
 
-        #Should check folders existence instead maybe?
-        #Just takes too long to check every file still exists
-
-        for t in self.__tracks.keys():
-            if(not os.path.isfile(t)):
-                session.delete(session.query(Track).get(self.__tracks[t]))
         session.commit()
+        self.__update_search()
 
-        app.logger.debug('Checking for empty albums...')
-        for album in session.query(Album).filter(~Album.id.in_(session.query(Track.album_id).distinct())):
-            app.logger.debug(album.name + ' Removed')
-            album.artist.albums.remove(album)
-            session.delete(album)
-            self.__deleted_albums += 1
-        session.commit()
+        # The artists and albums we kept may refer to rows that were just deleted
+        self.__load_artists()
 
-        app.logger.debug('Checking for artists with no albums...')
-        for artist in session.query(Artist).filter(~Artist.id.in_(session.query(Album.artist_id))):
-            session.delete(artist)
-            self.__deleted_artists += 1
-        session.commit()
+    def __delete_unused(self, table, used, kind):
+        """Deletes the rows of an artist or album table not in the used ids,
+        returns how many"""
+
+        unused = [ eid for eid, in session.execute(select([ table.c.id ]).where(~table.c.id.in_(used))) ]
+        for chunk in chunks(unused):
+            session.execute(table.delete().where(table.c.id.in_(chunk)))
+        for eid in unused:
+            self.__changed(eid, kind)
+        return len(unused)
 
     def __remove_track(self, track):
         track.album.tracks.remove(track)
         track.folder.tracks.remove(track)
         # As we don't have a track -> playlists relationship, SQLAlchemy doesn't know it has to remove tracks
         # from playlists as well, so let's help it
-        for playlist in self.__playlists:
-            if track in playlist.tracks:
-                playlist.tracks.remove(track)
+        session.execute(playlist_track_assoc.delete().where(playlist_track_assoc.c.track_id == track.id))
 
         session.delete(track)
         self.__deleted_tracks += 1
 
+    def __changed(self, eid, *kinds):
+        """Records an entity the search index has to look at again"""
+
+        if not self.__search:
+            return
+
+        for kind in kinds:
+            ids = self.__search_changes.setdefault(kind, set())
+            if ids is None:
+                continue
+            ids.add(eid)
+            if len(ids) > self.SEARCH_CHANGES_LIMIT:
+                self.__search_changes[kind] = None
+
+    def __update_search(self):
+        # Only what changed since the last update gets indexed
+        if self.__search:
+            self.__search.update(self.__search_changes)
+            self.__search_changes = {}
+
     def stats(self):
         return (self.__added_artists, self.__added_albums, self.__added_tracks), (self.__deleted_artists, self.__deleted_albums, self.__deleted_tracks)
 
+    def resumed(self):
+        """Directories and files skipped by resuming interrupted scans"""
+        return self.__resumed_directories, self.__resumed_files
+
@@ -0,0 +1,97 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests run against a SQLite database and a cache directory of their own,
+set up before the application gets imported:
+
+    python -m unittest discover -s tests -t .
+"""
+
+import os, os.path
+import sys
+import shutil
+import struct
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+
+TEST_DIR = tempfile.mkdtemp(prefix = 'supysonic-tests-')
+
+for section in ('base', 'transcoding', 'daemon'):
+    if not config.config.has_section(section):
+        config.config.add_section(section)
+config.config.set('base', 'database_uri', 'sqlite:///' + os.path.join(TEST_DIR, 'db.sqlite'))
+config.config.set('base', 'cache_dir', os.path.join(TEST_DIR, 'cache'))
+config.config.set('base', 'filetypes', 'flac,mp3')
+config.config.remove_option('base', 'log_file')
+
+import web
+import db
+from db import session
+
+def make_flac(path, title, artist, album, track = 1, seconds = 180, picture = None):
+    """Writes a FLAC file made of a STREAMINFO block and tags, without any
+    audio frame: enough for the tag readers"""
+
+    from mutagen.flac import FLAC, Picture
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    # 4096 samples blocks, 44.1kHz, 2 channels, 16 bits
+    info = struct.pack('>HH', 4096, 4096) + '\0' * 6
+    info += struct.pack('>Q', (44100 << 44) | (1 << 41) | (15 << 36) | (44100 * seconds)) + '\0' * 16
+    with open(path, 'wb') as f:
+        f.write('fLaC' + struct.pack('>I', 0x80000000 | len(info)) + info)
+
+    tags = FLAC(path)
+    tags['title'] = title
+    tags['artist'] = tags['albumartist'] = artist
+    tags['album'] = album
+    tags['tracknumber'] = str(track)
+    if picture:
+        p = Picture()
+        p.type = 3
+        p.mime = 'image/jpeg'
+        p.data = picture
+        tags.add_picture(p)
+    tags.save()
+    return path
+
+class DBTestCase(unittest.TestCase):
+    """Starts every test with an empty database and library directory"""
+
+    def setUp(self):
+        db.metadata.drop_all()
+        db.metadata.create_all()
+        self.library = tempfile.mkdtemp(dir = TEST_DIR).decode('utf-8')
+
+    def tearDown(self):
+        session.remove()
+        shutil.rmtree(self.library, ignore_errors = True)
+
+    def add_root(self):
+        root = db.Folder(root = True, path = self.library, name_key = db.name_key(os.path.basename(self.library)))
+        session.add(root)
+        session.commit()
+        return root
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os.path
+import signal
+import struct
+import unittest
+
+import covers
+from tests import DBTestCase, make_flac
+from db import Folder, session
+from managers.user import UserManager
+from scanner import Scanner
+from web import app
+
+class ArtLocationTestCase(DBTestCase):
+    def setUp(self):
+        super(ArtLocationTestCase, self).setUp()
+        self.picture = covers.encode(covers.Image.new('RGB', (50, 50)))
+        self.path = make_flac(os.path.join(self.library, u'Artist', u'Album', u'01.flac'), u'Title', u'Artist', u'Album',
+            picture = self.picture)
+
+    def test_flac(self):
+        offset, length = covers.art_location(self.path)
+        self.assertEqual(covers.cover_data(self.path, offset, length), self.picture)
+
+    def test_truncated_flac(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        for size in xrange(0, len(data), 7):
+            with open(self.path, 'wb') as f:
+                f.write(data[:size])
+            location = covers.art_location(self.path)
+            if location:
+                self.assertLessEqual(sum(location), len(data))
+
+    def test_unterminated_id3_description(self):
+        # UTF-16 description running to the end of the last frame, without padding after it
+        body = '\x01image/jpeg\0\x03' + 'a\0b\0'
+        frame = 'APIC' + struct.pack('>I', len(body)) + '\0\0' + body
+        path = os.path.join(self.library, u'unterminated.mp3')
+        with open(path, 'wb') as f:
+            f.write('ID3\x03\0\0' + struct.pack('>I', len(frame)) + frame)
+
+        signal.signal(signal.SIGALRM, lambda signum, frame: self.fail('Still looking for the end of the description'))
+        signal.alarm(5)
+        try:
+            self.assertIsNone(covers.art_location(path))
+        finally:
+            signal.alarm(0)
+
+    def test_truncated_flac_request(self):
+        UserManager.add(u'alice', u'secret', u'alice@example.com', False)
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        root_id = self.add_root().id
+        Scanner(session).scan(session.query(Folder).get(root_id))
+        folder_id = session.query(Folder.id).filter(Folder.root == False).scalar()
+
+        # Cut in the middle of the picture block, the request looks for the art again
+        with open(self.path, 'wb') as f:
+            f.write(data[:data.index('image/jpeg') + 20])
+        folder = session.query(Folder).get(folder_id)
+        folder.cover_art = folder.cover_art_offset = folder.cover_art_length = None
+        session.commit()
+
+        rv = app.test_client().get('/rest/getCoverArt.view', query_string = { 'u': 'alice', 'p': 'secret', 'id': str(folder_id) })
+        self.assertEqual(rv.status_code, 404)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, os.path
+import unittest
+
+from tests import DBTestCase, make_flac
+from db import session
+from scanner import Scanner
+import fulltext
+
+class SearchIndexTestCase(DBTestCase):
+    def setUp(self):
+        DBTestCase.setUp(self)
+        session.execute('DROP TABLE IF EXISTS search_fts')
+        session.commit()
+        self.__saved = fulltext._index
+        self.versions = []
+
+        versions = self.__versions = fulltext.versions
+        def counting_versions(kind, ids = None):
+            self.versions.append((kind, ids))
+            return versions(kind, ids)
+        fulltext.versions = counting_versions
+
+    def tearDown(self):
+        fulltext.versions = self.__versions
+        fulltext._index = self.__saved
+        path = os.path.join(fulltext.config.get('base', 'cache_dir'), 'search_index')
+        if os.path.exists(path):
+            os.remove(path)
+        DBTestCase.tearDown(self)
+
+    def index(self, backend):
+        # The scanner picks the index of the process
+        fulltext._index = backend()
+        return fulltext._index
+
+    def titles(self, index, kind, query):
+        ids, total = index.search(kind, query, 0, 10)
+        return ids
+
+    def check_scanner_changes(self, backend):
+        index = self.index(backend)
+        root = self.add_root()
+        for album in (u'First', u'Second'):
+            for track in (1, 2):
+                make_flac(os.path.join(self.library, u'Artist', album, u'%02i.flac' % track),
+                    u'Song %i' % track, u'Artist', album, track)
+
+        s = Scanner(session)
+        s.scan(root)
+        # Built from scratch the first time
+        self.assertEqual([ ids for kind, ids in self.versions ], [ None ] * len(fulltext.KINDS))
+        self.assertEqual(len(self.titles(index, fulltext.TRACK, u'song')), 4)
+        self.assertEqual(len(self.titles(index, fulltext.ALBUM_FOLDER, u'second')), 1)
+
+        # Then only what the scanner touched gets looked up
+        del self.versions[:]
+        s.remove_file(os.path.join(self.library, u'Artist', u'Second', u'01.flac'), root)
+        s.remove_file(os.path.join(self.library, u'Artist', u'Second', u'02.flac'), root)
+        s.commit()
+        self.assertNotIn(None, [ ids for kind, ids in self.versions ])
+        self.assertEqual(sorted(kind for kind, ids in self.versions),
+            sorted([ fulltext.ALBUM, fulltext.TRACK, fulltext.ALBUM_FOLDER, fulltext.ARTIST_FOLDER ]))
+        self.assertEqual(len(self.titles(index, fulltext.TRACK, u'song')), 2)
+        self.assertEqual(self.titles(index, fulltext.ALBUM, u'second'), [])
+        self.assertEqual(len(self.titles(index, fulltext.ALBUM, u'first')), 1)
+        # The emptied folder is now an artist one
+        self.assertEqual(self.titles(index, fulltext.ALBUM_FOLDER, u'second'), [])
+        self.assertEqual(len(self.titles(index, fulltext.ARTIST_FOLDER, u'second')), 1)
+
+        # A full comparison agrees
+        self.assertEqual(index.update(), 0)
+
+    def test_builtin_scanner_changes(self):
+        self.check_scanner_changes(fulltext.BuiltinIndex)
+
+    @unittest.skipUnless(fulltext.SQLiteIndex.available(), 'SQLite built without FTS5')
+    def test_sqlite_scanner_changes(self):
+        self.check_scanner_changes(fulltext.SQLiteIndex)
+
+    def check_unaccented(self, backend):
+        index = self.index(backend)
+        root = self.add_root()
+        # Accented tags only, paths have to be encodable with whatever locale the tests run under
+        make_flac(os.path.join(self.library, u'Mo', u'No Mythologies to Follow', u'01.flac'),
+            u'Kamikaze Stra\xdfe', u'M\xf8', u'No Mythologies to Follow')
+        Scanner(session).scan(root)
+
+        self.assertEqual(len(self.titles(index, fulltext.ARTIST, u'mo')), 1)
+        self.assertEqual(len(self.titles(index, fulltext.TRACK, u'strasse')), 1)
+        self.assertEqual(len(self.titles(index, fulltext.TRACK, u'Stra\xdfe m\xf8')), 1)
+        self.assertEqual(len(self.titles(index, fulltext.ALBUM, u'M\xd8 follow')), 1)
+
+    def test_builtin_unaccented(self):
+        self.check_unaccented(fulltext.BuiltinIndex)
+
+    @unittest.skipUnless(fulltext.SQLiteIndex.available(), 'SQLite built without FTS5')
+    def test_sqlite_unaccented(self):
+        self.check_unaccented(fulltext.SQLiteIndex)
+
+    def test_nothing_changed(self):
+        index = self.index(fulltext.BuiltinIndex)
+        root = self.add_root()
+        make_flac(os.path.join(self.library, u'Artist', u'Album', u'01.flac'), u'Title', u'Artist', u'Album')
+        s = Scanner(session)
+        s.scan(root)
+
+        commits = []
+        index._commit = lambda: commits.append(True)
+        del self.versions[:]
+        s.commit()
+        self.assertEqual(self.versions, [])
+        self.assertEqual(commits, [])
+
+        self.assertEqual(index.update(), 0)
+        self.assertEqual(commits, [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os.path
+import unittest
+
+import config
+import covers
+from tests import DBTestCase, make_flac
+from db import ClientPrefs, Folder, Track, User, session
+from managers.user import UserManager
+from scanner import Scanner
+from web import app
+
+class StreamTestCase(DBTestCase):
+    def setUp(self):
+        super(StreamTestCase, self).setUp()
+        config.config.set('transcoding', 'transcoder_flac_ogg', 'cat %srcpath')
+        UserManager.add(u'alice', u'secret', u'alice@example.com', False)
+        self.path = make_flac(os.path.join(self.library, u'Artist', u'Album', u'01.flac'), u'Title', u'Artist', u'Album')
+        Scanner(session).scan(self.add_root())
+        self.track_id = session.query(Track.id).scalar()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        config.config.remove_option('transcoding', 'transcoder_flac_ogg')
+        super(StreamTestCase, self).tearDown()
+
+    def stream(self, **params):
+        params.update(u = 'alice', p = 'secret', id = str(self.track_id))
+        return self.client.get('/rest/stream.view', query_string = params)
+
+    def test_transcoded_without_estimate(self):
+        with open(self.path, 'rb') as f:
+            data = f.read()
+
+        # Transcoded as it is sent, then from the cache
+        for i in xrange(2):
+            rv = self.stream(estimateContentLength = 'true')
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.data, data)
+            self.assertEqual(rv.headers['Content-Type'], 'audio/ogg')
+            if i == 0:
+                self.assertNotIn('Content-Length', rv.headers)
+            else:
+                self.assertEqual(rv.headers['Content-Length'], str(len(data)))
+
+    def test_raw_with_preferred_format(self):
+        user_id = session.query(User.id).filter(User.name == u'alice').scalar()
+        session.add(ClientPrefs(user_id = user_id, client_name = u'tests', format = u'mp3'))
+        session.commit()
+
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        rv = self.stream(format = 'raw', c = 'tests')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.data, data)
+        self.assertEqual(rv.mimetype, 'audio/flac')
+
+    def test_jsonp_without_callback(self):
+        # Allowed for stream, as some clients do
+        rv = self.stream(f = 'jsonp')
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.headers['Content-Type'], 'audio/ogg')
+
+        rv = self.client.get('/rest/stream.view', query_string = { 'u': 'alice', 'p': 'wrong', 'id': str(self.track_id), 'f': 'jsonp' })
+        self.assertEqual(rv.status_code, 401)
+        self.assertEqual(rv.mimetype, 'application/json')
+        self.assertIn('"code":40', rv.data)
+
+class CoverArtTestCase(DBTestCase):
+    def setUp(self):
+        super(CoverArtTestCase, self).setUp()
+        UserManager.add(u'alice', u'secret', u'alice@example.com', False)
+        self.client = app.test_client()
+
+        self.reads = 0
+        self.embedded_art = covers.embedded_art
+        def embedded_art(path):
+            self.reads += 1
+            return self.embedded_art(path)
+        covers.embedded_art = embedded_art
+
+    def tearDown(self):
+        covers.embedded_art = self.embedded_art
+        super(CoverArtTestCase, self).tearDown()
+
+    def cover(self, folder_id, **params):
+        params.update(u = 'alice', p = 'secret', id = str(folder_id))
+        return self.client.get('/rest/getCoverArt.view', query_string = params)
+
+    def test_no_art(self):
+        for number in (1, 2, 3):
+            make_flac(os.path.join(self.library, u'Artist', u'Album', u'%02i.flac' % number), u'Title', u'Artist', u'Album', number)
+        root_id = self.add_root().id
+        Scanner(session).scan(session.query(Folder).get(root_id))
+        folder_id = session.query(Folder.id).filter(Folder.root == False).scalar()
+
+        # Every track is looked at once, then never again
+        self.assertEqual(self.cover(folder_id).status_code, 404)
+        self.assertEqual(self.reads, 3)
+        for i in xrange(3):
+            self.assertEqual(self.cover(folder_id).status_code, 404)
+        self.assertEqual(self.reads, 3)
+
+        # Found by the next scan of the folder
+        with open(os.path.join(self.library, u'Artist', u'Album', u'cover.jpg'), 'wb') as f:
+            f.write(covers.encode(covers.Image.new('RGB', (50, 50))))
+        Scanner(session).scan(session.query(Folder).get(root_id))
+        rv = self.cover(folder_id)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.mimetype, 'image/jpeg')
+
+    def test_jsonp_without_callback(self):
+        # Its error response as well
+        root_id = self.add_root().id
+        make_flac(os.path.join(self.library, u'Artist', u'Album', u'01.flac'), u'Title', u'Artist', u'Album')
+        Scanner(session).scan(session.query(Folder).get(root_id))
+        folder_id = session.query(Folder.id).filter(Folder.root == False).scalar()
+
+        rv = self.cover(folder_id, f = 'jsonp')
+        self.assertEqual(rv.status_code, 404)
+        self.assertEqual(rv.mimetype, 'application/json')
+
+if __name__ == '__main__':
+    unittest.main()
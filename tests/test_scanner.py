@@ -0,0 +1,70 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os.path
+import unittest
+
+from tests import DBTestCase, make_flac
+from db import Folder, Track, session
+from scanner import Scanner
+
+class ScannerTestCase(DBTestCase):
+    def make_library(self):
+        # Album folders of several artists, siblings under the root folder
+        for artist in (u'Alpha', u'Beta', u'Gamma', u'Delta'):
+            for album in (u'One', u'Two'):
+                for number in (1, 2, 3):
+                    make_flac(os.path.join(self.library, artist, album, u'%02i.flac' % number),
+                        u'%s %i' % (album, number), artist, album, number)
+
+    def check_scan(self, **kwargs):
+        self.make_library()
+        root = self.add_root()
+        Scanner(session, **kwargs).scan(root)
+
+        self.assertEqual(session.query(Track).count(), 24)
+        folders = session.query(Folder).filter(Folder.root == False).all()
+        self.assertEqual(len(folders), 8)
+        self.assertEqual(len(set(f.mp_path for f in folders)), 8)
+        self.assertTrue(all(t.folder.path == os.path.dirname(t.path) for t in session.query(Track)))
+
+    def test_scan_sibling_folders(self):
+        self.check_scan()
+
+    def test_scan_sibling_folders_jobs(self):
+        self.check_scan(jobs = 2)
+
+    def test_scan_sibling_folders_bulk(self):
+        self.check_scan(bulk = True)
+
+    def test_rescan(self):
+        self.check_scan()
+        make_flac(os.path.join(self.library, u'Epsilon', u'Three', u'01.flac'), u'Three', u'Epsilon', u'Three')
+        root = session.query(Folder).filter(Folder.root == True).one()
+        scanner = Scanner(session)
+        scanner.scan(root)
+
+        self.assertEqual(scanner.stats()[0], (1, 1, 1))
+        self.assertEqual(session.query(Track).count(), 25)
+        self.assertEqual(len(set(f.mp_path for f in session.query(Folder).filter(Folder.root == False))), 9)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os, os.path
+import time
+import unittest
+
+import tests
+from transcoding import TranscodeCache, TranscodingError, start_transcoding
+
+def producer(chunks, delay, status = 0):
+    # chunks of 8KiB, one every delay seconds
+    return [ [ 'sh', '-c', 'for i in $(seq {}); do head -c 8192 /dev/zero; sleep {}; done; exit {}'.format(chunks, delay, status) ] ]
+
+class TranscodeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = TranscodeCache()
+        self.procs = []
+
+    def start(self, commands):
+        def start():
+            proc = start_transcoding(commands)
+            self.procs.append(proc)
+            return proc
+        return start
+
+    def wait_for(self, condition, timeout = 5):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def rendition(self, key):
+        return os.path.join(tests.TEST_DIR, 'cache', 'transcodes', key)
+
+    def test_complete(self):
+        stream = self.cache.stream('complete', self.start(producer(3, 0)))
+        self.assertEqual(len(''.join(stream)), 3 * 8192)
+        self.assertTrue(self.wait_for(lambda: self.cache.get('complete')))
+
+    def test_stops_without_readers(self):
+        stream = self.cache.stream('abandoned', self.start(producer(1000, 0.05)))
+        next(stream)
+        stream.close()
+
+        self.assertTrue(self.wait_for(lambda: self.procs[0].poll() is not None))
+        self.assertFalse(os.path.exists(self.rendition('abandoned') + '.part'))
+        self.assertIsNone(self.cache.get('abandoned'))
+
+    def test_shared_goes_on(self):
+        first = self.cache.stream('shared', self.start(producer(30, 0.05)))
+        second = self.cache.stream('shared', self.start(producer(30, 0.05)))
+        next(first)
+        first.close()
+
+        # Only one transcoder, still read by the other request
+        self.assertEqual(len(''.join(second)), 30 * 8192)
+        self.assertEqual(len(self.procs), 1)
+        self.assertTrue(self.wait_for(lambda: self.cache.get('shared')))
+
+    def test_restarted_after_abandon(self):
+        stream = self.cache.stream('again', self.start(producer(1000, 0.05)))
+        next(stream)
+        stream.close()
+        self.assertTrue(self.wait_for(lambda: not os.path.exists(self.rendition('again') + '.part')))
+
+        self.assertEqual(len(''.join(self.cache.stream('again', self.start(producer(2, 0))))), 2 * 8192)
+        self.assertEqual(len(self.procs), 2)
+
+    def test_failure_reaches_followers(self):
+        first = self.cache.stream('failed', self.start(producer(5, 0.1, 1)))
+        second = self.cache.stream('failed', self.start(producer(5, 0.1, 1)))
+        for stream in (first, second):
+            with self.assertRaises(TranscodingError):
+                for data in stream:
+                    pass
+        self.assertIsNone(self.cache.get('failed'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import hashlib
+import unittest
+
+import config
+from tests import DBTestCase
+from db import User, session
+from managers.user import UserManager
+from web import app
+
+class AuthCacheTestCase(DBTestCase):
+    def setUp(self):
+        super(AuthCacheTestCase, self).setUp()
+        config.config.set('base', 'token_auth', 'yes')
+        UserManager.add(u'alice', u'secret', u'alice@example.com', False)
+        self.user_id = session.query(User.id).filter(User.name == u'alice').scalar()
+
+    def tearDown(self):
+        config.config.remove_option('base', 'token_auth')
+        super(AuthCacheTestCase, self).tearDown()
+
+    def update_elsewhere(self, **values):
+        # As another process would, the session doesn't know about it
+        session.execute(User.__table__.update().where(User.__table__.c.id == self.user_id).values(**values))
+        session.commit()
+        session.remove()
+
+    def test_fresh_user(self):
+        status, user = UserManager.try_auth(u'alice', u'secret')
+        self.assertEqual(status, UserManager.SUCCESS)
+        self.assertFalse(user.admin)
+        session.remove()
+
+        hits = UserManager.auth_hits
+        self.update_elsewhere(admin = True)
+        status, user = UserManager.try_auth(u'alice', u'secret')
+        self.assertEqual(status, UserManager.SUCCESS)
+        self.assertEqual(UserManager.auth_hits, hits + 1)
+        self.assertTrue(user.admin)
+
+        # Changes made by the request are those written back
+        user.lastfm_session = u'abcdef'
+        session.commit()
+        session.remove()
+        user = session.query(User).get(self.user_id)
+        self.assertTrue(user.admin)
+        self.assertEqual(user.lastfm_session, u'abcdef')
+
+    def test_wrong_password(self):
+        UserManager.try_auth(u'alice', u'secret')
+        session.remove()
+        self.assertEqual(UserManager.try_auth(u'alice', u'wrong')[0], UserManager.WRONG_PASS)
+
+    def test_deleted_elsewhere(self):
+        UserManager.try_auth(u'alice', u'secret')
+        session.remove()
+
+        session.execute(User.__table__.delete().where(User.__table__.c.id == self.user_id))
+        session.commit()
+        session.remove()
+        self.assertEqual(UserManager.try_auth(u'alice', u'secret'), (UserManager.NO_SUCH_USER, None))
+
+    def test_password_changed_elsewhere(self):
+        self.assertEqual(UserManager.try_auth(u'alice', u'secret')[0], UserManager.SUCCESS)
+        session.remove()
+
+        # By cli.py or another worker, this process' entry is still there
+        self.update_elsewhere(password = hashlib.sha1('changed').digest())
+        self.assertEqual(UserManager.try_auth(u'alice', u'secret')[0], UserManager.WRONG_PASS)
+        self.assertEqual(UserManager.try_auth(u'alice', u'changed')[0], UserManager.SUCCESS)
+
+    def test_token_password_changed_elsewhere(self):
+        token = lambda password, salt: hashlib.md5(password + salt).hexdigest()
+        self.assertEqual(UserManager.try_token_auth(u'alice', token('secret', 'abc'), u'abc')[0], UserManager.SUCCESS)
+        session.remove()
+
+        self.update_elsewhere(token_password = u'changed'.encode('hex'))
+        self.assertEqual(UserManager.try_token_auth(u'alice', token('secret', 'def'), u'def')[0], UserManager.WRONG_PASS)
+        self.assertEqual(UserManager.try_token_auth(u'alice', token('changed', 'ghi'), u'ghi')[0], UserManager.SUCCESS)
+
+    def test_announced_version(self):
+        client = app.test_client()
+        params = { 'u': 'alice', 't': hashlib.md5('secret' + 'abc').hexdigest(), 's': 'abc', 'f': 'json' }
+        rv = client.get('/rest/ping.view', query_string = params)
+        self.assertIn('"status":"ok"', rv.data)
+        self.assertIn('"version":"1.13.0"', rv.data)
+
+        config.config.remove_option('base', 'token_auth')
+        rv = client.get('/rest/ping.view', query_string = params)
+        self.assertIn('"code":41', rv.data)
+        self.assertIn('"version":"1.8.0"', rv.data)
+        config.config.set('base', 'token_auth', 'yes')
+
+    def test_token(self):
+        token = lambda salt: hashlib.md5('secret' + salt).hexdigest()
+        self.assertEqual(UserManager.try_token_auth(u'alice', token('abc'), u'abc')[0], UserManager.SUCCESS)
+        session.remove()
+
+        self.update_elsewhere(admin = True)
+        status, user = UserManager.try_token_auth(u'alice', token('def'), u'def')
+        self.assertEqual(status, UserManager.SUCCESS)
+        self.assertTrue(user.admin)
+        self.assertEqual(UserManager.try_token_auth(u'alice', token('def'), u'ghi')[0], UserManager.WRONG_PASS)
+
+if __name__ == '__main__':
+    unittest.main()
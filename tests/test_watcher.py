@@ -0,0 +1,82 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os.path
+import unittest
+
+from tests import DBTestCase, make_flac
+from db import Folder, Track, session
+import scanner
+import watcher
+
+class WatcherTestCase(DBTestCase):
+    def test_retry_failed_batch(self):
+        self.add_root()
+        path = make_flac(os.path.join(self.library, u'Artist', u'Album', u'01.flac'), u'Title', u'Artist', u'Album')
+        w = watcher.SupysonicWatcher()
+
+        commit = scanner.Scanner.commit
+        def failing_commit(self):
+            scanner.Scanner.commit = commit
+            raise IOError('Disk full')
+
+        # Fails once the track and its folder are flushed, the whole batch is rolled back
+        scanner.Scanner.commit = failing_commit
+        try:
+            w.queue(path, watcher.OP_SCAN, False)
+            w._SupysonicWatcher__process()
+        finally:
+            scanner.Scanner.commit = commit
+        self.assertEqual(session.query(Track).count(), 0)
+
+        # Queued again, the new scanner doesn't take the file as stored
+        w._SupysonicWatcher__process()
+        self.assertEqual(session.query(Track).count(), 1)
+        self.assertEqual(session.query(Track).one().folder.path, os.path.dirname(path))
+        self.assertEqual(session.query(Folder).filter(Folder.root == False).count(), 1)
+
+        # Nothing left to apply
+        w._SupysonicWatcher__process()
+        self.assertEqual(session.query(Track).count(), 1)
+
+    def test_failed_batch_retried_once(self):
+        self.add_root()
+        path = make_flac(os.path.join(self.library, u'Artist', u'Album', u'01.flac'), u'Title', u'Artist', u'Album')
+        w = watcher.SupysonicWatcher()
+
+        commit = scanner.Scanner.commit
+        def failing_commit(self):
+            raise IOError('Disk full')
+
+        scanner.Scanner.commit = failing_commit
+        try:
+            w.queue(path, watcher.OP_SCAN, False)
+            w._SupysonicWatcher__process()
+            w._SupysonicWatcher__process()
+        finally:
+            scanner.Scanner.commit = commit
+
+        # Given up after the second failure
+        w._SupysonicWatcher__process()
+        self.assertEqual(session.query(Track).count(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
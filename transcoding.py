@@ -0,0 +1,706 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path
+import datetime
+import errno
+import fcntl
+import hashlib
+import io
+import subprocess
+import tempfile
+import threading
+import time
+import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import ushlex as shlex
+
+import config
+from web import app
+from db import Track, ClientPrefs, session
+
+# Bytes read at once from a transcoder output, overridden by [transcoding] chunk_size
+DEFAULT_CHUNK_SIZE = 8192
+
+class TranscodingError(Exception):
+    pass
+
+class TranscodersBusy(TranscodingError):
+    pass
+
+def chunk_size():
+    return int(config.get('transcoding', 'chunk_size') or DEFAULT_CHUNK_SIZE)
+
+def transcoding_target(track, format = None, max_bitrate = None, prefs = None):
+    """Returns whether a track has to be transcoded, along with the format
+    and bitrate it is streamed as, given the format and maximum bitrate asked
+    by a client and the preferences of that client"""
+
+    do_transcoding = False
+    src_suffix = track.suffix()
+    dst_suffix = src_suffix
+    dst_bitrate = track.bitrate
+
+    if max_bitrate and dst_bitrate > max_bitrate:
+        do_transcoding = True
+        dst_bitrate = max_bitrate
+
+    if format and format != 'raw' and format != src_suffix:
+        do_transcoding = True
+        dst_suffix = format
+
+    if prefs:
+        if prefs.format:
+            dst_suffix = prefs.format
+        if prefs.bitrate and prefs.bitrate < dst_bitrate:
+            dst_bitrate = prefs.bitrate
+
+    if not format and src_suffix == 'flac':
+        dst_suffix = 'ogg'
+        dst_bitrate = 320
+        do_transcoding = True
+
+    return do_transcoding, dst_suffix, dst_bitrate
+
+def prepare_transcoding_cmdline(base_cmdline, input_file,
+                                input_format, output_format, output_bitrate, offset = 0):
+    if not base_cmdline:
+        return None
+
+    return base_cmdline\
+        .replace('%srcpath', '"'+input_file+'"')\
+        .replace('%srcfmt', input_format)\
+        .replace('%outfmt', output_format)\
+        .replace('%outrate', str(output_bitrate))\
+        .replace('%offset', str(offset))
+
+def transcoding_cmdlines(src_suffix, dst_suffix):
+    """Returns the configured transcoder, decoder and encoder command lines
+    for a pair of formats, either the transcoder or the other two being None"""
+
+    transcoder = config.get('transcoding', 'transcoder_{}_{}'.format(src_suffix, dst_suffix))
+
+    decoder = config.get('transcoding', 'decoder_' + src_suffix) or config.get('transcoding', 'decoder')
+    encoder = config.get('transcoding', 'encoder_' + dst_suffix) or config.get('transcoding', 'encoder')
+
+    if not transcoder and (not decoder or not encoder):
+        transcoder = config.get('transcoding', 'transcoder')
+        if not transcoder:
+            raise TranscodingError('No way to transcode from {} to {}'.format(src_suffix, dst_suffix))
+
+    if transcoder:
+        return transcoder, None, None
+    return None, decoder, encoder
+
+def can_seek(src_suffix, dst_suffix):
+    """Tells whether the transcoding command lines take an %offset at which
+    to start"""
+
+    try:
+        return any('%offset' in x for x in transcoding_cmdlines(src_suffix, dst_suffix) if x)
+    except TranscodingError:
+        return False
+
+def transcoding_commands(path, src_suffix, dst_suffix, dst_bitrate, offset = 0):
+    """Returns the command lines, as lists of arguments, of the processes
+    transcoding a file from offset seconds: either a single transcoder or a
+    decoder and an encoder"""
+
+    transcoder, decoder, encoder = map(lambda x: prepare_transcoding_cmdline(x, path, src_suffix, dst_suffix, dst_bitrate, offset),
+        transcoding_cmdlines(src_suffix, dst_suffix))
+
+    if transcoder and '|' in transcoder:
+        pipe_index = transcoder.index('|')
+        decoder = transcoder[:pipe_index]
+        encoder = transcoder[pipe_index+1:]
+        transcoder = None
+
+    split = lambda cmdline: map(lambda s: s.decode('UTF8'), shlex.split(cmdline.encode('utf8')))
+    if transcoder:
+        return [ split(transcoder) ]
+    return [ split(decoder), split(encoder) ]
+
+def start_transcoding(commands, nice = None):
+    """Starts the processes of transcoding_commands(), returns the one
+    writing the transcoded stream on its standard output. The decoder, if
+    any, is available as its decoder attribute. nice is added to the
+    niceness of the processes."""
+
+    preexec_fn = (lambda: os.nice(nice)) if nice else None
+    if len(commands) == 1:
+        proc = subprocess.Popen(commands[0], stdout = subprocess.PIPE, shell = False, preexec_fn = preexec_fn)
+        proc.decoder = None
+        return proc
+
+    dec_proc = subprocess.Popen(commands[0], stdout = subprocess.PIPE, shell = False, preexec_fn = preexec_fn)
+    proc = subprocess.Popen(commands[1], stdin = dec_proc.stdout, stdout = subprocess.PIPE, shell = False, preexec_fn = preexec_fn)
+    # Only the encoder reads it, so that the decoder gets a broken pipe if the encoder dies
+    dec_proc.stdout.close()
+    proc.decoder = dec_proc
+    return proc
+
+def stop_transcoding(proc, kill = True):
+    """Waits for the processes started by start_transcoding(), terminating
+    them first if kill is set. Returns the exit status of the last one."""
+
+    proc.stdout.close()
+    for p in (proc, proc.decoder):
+        if p is None:
+            continue
+        if kill and p.poll() is None:
+            p.terminate()
+        p.wait()
+
+    # Supervisor slots
+    for fd in getattr(proc, 'slots', ()):
+        os.close(fd)
+    proc.slots = []
+    proc.stopped = True
+    return proc.returncode
+
+class TranscodeSupervisor:
+    """Limits the number of transcodings running at once on the host, all
+    processes serving requests included, and per user.
+
+    Slots are files under cache_dir/transcode_slots, locked with flock for
+    as long as a transcoding runs. Locks go away with the process holding
+    them, so a crashed worker can't leak slots. Requests wait in turn for a
+    free slot, up to a timeout."""
+
+    POLL_DELAY = 0.1
+    # Transcodings whose processes are done but weren't stopped for that long were abandoned
+    ORPHAN_DELAY = 60
+
+    def __init__(self):
+        cache_dir = config.get('base', 'cache_dir') or os.path.join(tempfile.gettempdir(), 'supysonic')
+        self.__dir = os.path.join(cache_dir, 'transcode_slots')
+
+        self.__max = int(config.get('transcoding', 'max_transcodes') or multiprocessing.cpu_count())
+        # 0 means no limit
+        self.__max_user = int(config.get('transcoding', 'max_user_transcodes') or 0)
+        self.__timeout = float(config.get('transcoding', 'queue_timeout') or 10)
+
+        # Transcodings started by this process, by encoder pid
+        self.__running = {}
+        self.__finished_at = {}
+        self.__lock = threading.Lock()
+
+    def start(self, commands, user_id = None, nice = None, timeout = None):
+        """Starts transcoding processes as start_transcoding() does, once a
+        slot is free. Waits up to timeout seconds, the configured queue
+        timeout by default, then raises TranscodersBusy."""
+
+        self.reap()
+        if not os.path.exists(self.__dir):
+            try:
+                os.makedirs(self.__dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        deadline = time.time() + (self.__timeout if timeout is None else timeout)
+        slots = self.__acquire(user_id)
+        while slots is None:
+            if time.time() >= deadline:
+                raise TranscodersBusy('Too many transcodings in progress')
+            time.sleep(self.POLL_DELAY)
+            slots = self.__acquire(user_id)
+
+        try:
+            proc = start_transcoding(commands, nice)
+        except:
+            for fd in slots:
+                os.close(fd)
+            raise
+
+        proc.slots = slots
+        with self.__lock:
+            self.__running[proc.pid] = proc
+        return proc
+
+    def counts(self):
+        """Returns the number of transcodings running on the host, and a
+        dict of the number of those per user id"""
+
+        self.reap()
+        host, users = 0, {}
+        if not os.path.exists(self.__dir):
+            return host, users
+
+        for name in os.listdir(self.__dir):
+            if not self.__busy(name):
+                continue
+            if name.startswith('host-'):
+                host += 1
+            elif name.startswith('user-'):
+                user_id = name[5:].rsplit('-', 1)[0]
+                users[user_id] = users.get(user_id, 0) + 1
+        return host, users
+
+    def reap(self):
+        """Cleans up after transcodings of this process whose stream was
+        never closed: releases their slots and stops decoders left running
+        after their encoder exited"""
+
+        now = time.time()
+        with self.__lock:
+            running = self.__running.items()
+
+        for pid, proc in running:
+            if getattr(proc, 'stopped', False):
+                done = True
+            elif proc.poll() is None:
+                continue
+            else:
+                # Output may still be in the pipe, waiting to be read
+                finished_at = self.__finished_at.setdefault(pid, now)
+                done = now - finished_at > self.ORPHAN_DELAY
+                if done:
+                    app.logger.warn('Reaping abandoned transcoding process %i', pid)
+                    stop_transcoding(proc)
+
+            if done:
+                with self.__lock:
+                    self.__running.pop(pid, None)
+                    self.__finished_at.pop(pid, None)
+
+    def __acquire(self, user_id):
+        slots = []
+        if user_id is not None and self.__max_user:
+            fd = self.__lock_slot('user-{}'.format(user_id), self.__max_user)
+            if fd is None:
+                return None
+            slots.append(fd)
+
+        fd = self.__lock_slot('host', self.__max)
+        if fd is None:
+            for fd in slots:
+                os.close(fd)
+            return None
+        slots.append(fd)
+        return slots
+
+    def __lock_slot(self, prefix, count):
+        for i in xrange(count):
+            fd = self.__open('{}-{}'.format(prefix, i))
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except IOError:
+                os.close(fd)
+        return None
+
+    def __busy(self, name):
+        fd = self.__open(name)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except IOError:
+            return True
+        finally:
+            os.close(fd)
+
+    def __open(self, name):
+        fd = os.open(os.path.join(self.__dir, name), os.O_RDWR | os.O_CREAT, 0644)
+        # Transcoding processes mustn't inherit the lock
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        return fd
+
+class ProcessStream:
+    """Iterates over the output of a transcoding process in fixed size
+    chunks.
+
+    Output is only read as chunks are consumed: with a slow client the pipe
+    fills up and the transcoder waits, rather than its output piling up in
+    memory. Closing the stream, as WSGI servers do when the client goes
+    away, stops the processes."""
+
+    def __init__(self, proc, size = None):
+        self.__proc = proc
+        self.__size = size or chunk_size()
+        self.__closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.__closed:
+            raise StopIteration
+
+        data = self.__proc.stdout.read(self.__size)
+        if not data:
+            self.__closed = True
+            stop_transcoding(self.__proc, kill = False)
+            raise StopIteration
+        return data
+
+    def close(self):
+        if not self.__closed:
+            self.__closed = True
+            stop_transcoding(self.__proc)
+
+class TranscodeCache:
+    """Transcoded streams stored under cache_dir/transcodes, keyed by track,
+    modification time, format and bitrate.
+
+    A rendition is written to a .part file by a thread reading the
+    transcoder output, then renamed once complete. Requests, from any
+    process, asking for a rendition being written follow the .part file
+    rather than starting their own transcoder. Least recently used
+    renditions are evicted once the cache grows over its size limit.
+
+    Requests reading a rendition hold a shared lock on its .readers file,
+    the transcoding started by a request stops once no request holds it.
+    Followers get a TranscodingError if the rendition can't be completed."""
+
+    # How often a request following a rendition checks whether it grew
+    POLL_DELAY = 0.05
+    # A rendition that didn't grow for that long was abandoned by its writer
+    STALE_DELAY = 30
+    # How often a writer checks whether requests still read its rendition
+    READERS_DELAY = 1
+    # .readers files of renditions that weren't completed are removed after that long
+    READERS_EXPIRY = 24 * 3600
+
+    def __init__(self):
+        cache_dir = config.get('base', 'cache_dir') or os.path.join(tempfile.gettempdir(), 'supysonic')
+        self.__dir = os.path.join(cache_dir, 'transcodes')
+
+        # In MiB, 0 disables the cache
+        size = config.get('transcoding', 'cache_size')
+        self.__max_size = int(size if size is not None else 512) * 1024 * 1024
+
+    @property
+    def enabled(self):
+        return self.__max_size > 0
+
+    @staticmethod
+    def key(track, suffix, bitrate):
+        return hashlib.sha1('{}-{}-{}-{}'.format(track.id, track.last_modification, suffix, bitrate)).hexdigest()
+
+    def get(self, key):
+        """Returns the path of a complete rendition, None if it isn't cached"""
+
+        path = os.path.join(self.__dir, key)
+        try:
+            # Hits are what keep renditions from being evicted
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def stream(self, key, start):
+        """Returns a generator of the content of a rendition being written.
+        Unless another request already did, start is called to start the
+        transcoding processes."""
+
+        path = os.path.join(self.__dir, key)
+        self.__make_dir()
+        while True:
+            # Taken before claiming, so that a writer finding no reader is done with the rendition before
+            # anyone joins
+            readers = self.__open_readers(path)
+            fcntl.flock(readers, fcntl.LOCK_SH)
+            if os.path.exists(path):
+                # Completed in the meantime
+                break
+
+            fd = self.__claim(path)
+            if fd is not None:
+                try:
+                    proc = self.__start(fd, path, start)
+                except:
+                    os.close(readers)
+                    raise
+
+                # Kept on while any request, from any process, reads the rendition
+                thread = threading.Thread(target = self.__fill, args = (proc, fd, path, True))
+                thread.daemon = True
+                thread.start()
+                break
+
+            if os.path.exists(path + '.part'):
+                app.logger.debug('Sharing the transcoding of %s', key)
+                break
+
+            # Given up by its writer in between, claimed again
+            os.close(readers)
+
+        return self.__follow(path, readers)
+
+    def warm(self, key, start):
+        """Transcodes a rendition with the processes returned by start,
+        unless it is already cached or being transcoded. Returns whether it
+        did."""
+
+        path = os.path.join(self.__dir, key)
+        if os.path.exists(path):
+            return False
+
+        fd = self.__claim(path)
+        if fd is None:
+            return False
+
+        return self.__fill(self.__start(fd, path, start), fd, path)
+
+    def evict(self):
+        """Removes the least recently used renditions until the cache fits
+        its size limit"""
+
+        entries = []
+        names = set(os.listdir(self.__dir))
+        for name in names:
+            if name.endswith('.part'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.__dir, name))
+            except OSError:
+                continue
+
+            if name.endswith('.readers'):
+                rendition = name[:-len('.readers')]
+                if rendition not in names and rendition + '.part' not in names and time.time() - st.st_mtime > self.READERS_EXPIRY:
+                    self.__remove(os.path.join(self.__dir, name))
+                continue
+            entries.append((st.st_mtime, st.st_size, os.path.join(self.__dir, name)))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.__max_size:
+                break
+            app.logger.debug('Evicting transcoded stream %s', path)
+            self.__remove(path)
+            self.__remove(path + '.readers')
+            total -= size
+
+    def __make_dir(self):
+        if not os.path.exists(self.__dir):
+            try:
+                os.makedirs(self.__dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def __open_readers(self, path):
+        fd = os.open(path + '.readers', os.O_RDWR | os.O_CREAT, 0644)
+        # Transcoding processes mustn't inherit the lock
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        return fd
+
+    @staticmethod
+    def __remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def __claim(self, path):
+        """Creates the .part file of a rendition, returns its descriptor or
+        None if another request is writing it"""
+
+        part = path + '.part'
+        self.__make_dir()
+
+        try:
+            return os.open(part, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            if not self.__is_stale(part):
+                return None
+
+        app.logger.warn('Taking over abandoned transcoding of %s', path)
+        try:
+            os.remove(part)
+            return os.open(part, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError:
+            # Someone else took it over first
+            return None
+
+    def __start(self, fd, path, start):
+        try:
+            return start()
+        except:
+            os.close(fd)
+            os.remove(path + '.part')
+            raise
+
+    def __is_stale(self, part):
+        try:
+            return time.time() - os.path.getmtime(part) > self.STALE_DELAY
+        except OSError:
+            return False
+
+    def __fill(self, proc, fd, path, watched = False):
+        """Writes the output of proc to the rendition. If watched, stops as
+        soon as no request reads it anymore, otherwise, for pre-transcoding,
+        goes on until it is complete."""
+
+        readers = self.__open_readers(path) if watched else None
+        try:
+            size = chunk_size()
+            next_check = time.time() + self.READERS_DELAY
+            with os.fdopen(fd, 'wb') as f:
+                # Whatever is available, rather than waiting for a full chunk, requests follow the file as it grows
+                for data in iter(lambda: os.read(proc.stdout.fileno(), size), ''):
+                    f.write(data)
+                    f.flush()
+
+                    if readers is not None and time.time() >= next_check:
+                        next_check = time.time() + self.READERS_DELAY
+                        if self.__unread(readers):
+                            app.logger.debug('Nobody reads %s anymore, stopping its transcoding', path)
+                            self.__abort(proc, path)
+                            return False
+
+            status = stop_transcoding(proc, kill = False)
+            if status != 0:
+                raise TranscodingError('Transcoder exited with status {}'.format(status))
+            os.rename(path + '.part', path)
+        except:
+            app.logger.error('Transcoding to %s failed', path)
+            app.logger.error(traceback.format_exc())
+            self.__abort(proc, path)
+            return False
+        finally:
+            # Released once the .part file is gone, requests waiting for it then see how it ended
+            if readers is not None:
+                os.close(readers)
+
+        self.evict()
+        return True
+
+    @staticmethod
+    def __unread(readers):
+        try:
+            fcntl.flock(readers, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError:
+            return False
+
+    def __abort(self, proc, path):
+        if not getattr(proc, 'stopped', False):
+            stop_transcoding(proc)
+        self.__remove(path + '.part')
+
+    def __follow(self, path, readers):
+        """Returns a generator of the content of a rendition as it is
+        written, releasing readers once done"""
+
+        part = path + '.part'
+        # Unbuffered, stdio considers reaching the end of file as final
+        try:
+            f = io.open(part, 'rb', buffering = 0)
+        except IOError:
+            try:
+                # Completed in the meantime
+                f = io.open(path, 'rb', buffering = 0)
+            except IOError:
+                os.close(readers)
+                raise TranscodingError('Transcoding to {} failed'.format(path))
+
+        size = chunk_size()
+
+        def follow():
+            last_growth = time.time()
+            try:
+                with f:
+                    while True:
+                        data = f.read(size)
+                        if data:
+                            last_growth = time.time()
+                            yield data
+                            continue
+
+                        # The writer is done once the .part file is gone, renamed if it completed the rendition
+                        if not os.path.exists(part):
+                            for data in iter(lambda: f.read(size), ''):
+                                yield data
+                            if not os.path.exists(path):
+                                raise TranscodingError('Transcoding to {} failed'.format(path))
+                            return
+
+                        if time.time() - last_growth > self.STALE_DELAY:
+                            raise TranscodingError('Transcoding to {} stalled'.format(path))
+                        time.sleep(self.POLL_DELAY)
+            finally:
+                os.close(readers)
+
+        return follow()
+
+class PreTranscoder:
+    """Fills the transcode cache ahead of time with the renditions the most
+    played and recently played tracks are likely to be streamed as: the
+    default one, and those capped to the bitrates set in client preferences.
+
+    Transcoders run on a bounded pool of worker threads, each waiting on its
+    own transcoding processes, with a lowered CPU priority. They take slots
+    of the supervisor like requests do, waiting as long as needed."""
+
+    def __init__(self, cache, supervisor, jobs = 2, nice = 10):
+        self.__cache = cache
+        self.__supervisor = supervisor
+        self.__jobs = max(1, jobs)
+        self.__nice = nice
+
+    def renditions(self, count = 100, days = 7):
+        """Returns the (key, commands) of the renditions to transcode"""
+
+        tracks = session.query(Track).filter(Track.play_count > 0).order_by(Track.play_count.desc()).limit(count).all()
+        since = datetime.datetime.now() - datetime.timedelta(days = days)
+        popular = set(t.id for t in tracks)
+        tracks += [ t for t in session.query(Track).filter(Track.last_play >= since).order_by(Track.last_play.desc()).limit(count) if t.id not in popular ]
+
+        prefs = session.query(ClientPrefs.format, ClientPrefs.bitrate).filter(ClientPrefs.bitrate != None).distinct().all()
+
+        renditions = []
+        seen = set()
+        for track in tracks:
+            for pref in [ None ] + prefs:
+                do_transcoding, suffix, bitrate = transcoding_target(track, None, pref.bitrate if pref else None, pref)
+                key = TranscodeCache.key(track, suffix, bitrate)
+                if not do_transcoding or key in seen:
+                    continue
+                seen.add(key)
+
+                try:
+                    renditions.append((key, transcoding_commands(track.path, track.suffix(), suffix, bitrate)))
+                except TranscodingError, e:
+                    app.logger.warn('Not pre-transcoding %s: %s', track.path, e)
+
+        return renditions
+
+    def run(self, count = 100, days = 7):
+        """Transcodes the renditions that aren't cached yet. Returns the number
+        of renditions transcoded and the number of those already cached."""
+
+        renditions = self.renditions(count, days)
+        # Least popular first, the most popular then are the most recently used ones of the cache
+        renditions.reverse()
+
+        pool = ThreadPool(self.__jobs)
+        try:
+            done = pool.map(lambda r: self.__cache.warm(r[0], lambda: self.__supervisor.start(r[1], nice = self.__nice, timeout = float('inf'))), renditions, 1)
+        finally:
+            pool.terminate()
+
+        transcoded = sum(1 for d in done if d)
+        return transcoded, len(done) - transcoded
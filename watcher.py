@@ -0,0 +1,153 @@
+# coding: utf-8
+
+# This file is part of Supysonic.
+#
+# Supysonic is a Python implementation of the Subsonic server API.
+# Copyright (C) 2014  Alban 'spl0k' Féron
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, os.path
+import time
+import traceback
+
+import pyinotify
+
+import config
+from web import app
+from db import Folder, session
+from scanner import Scanner
+
+OP_SCAN = 1
+OP_REMOVE = 2
+
+class EventHandler(pyinotify.ProcessEvent):
+    def my_init(self, watcher):
+        self.__watcher = watcher
+
+    def process_IN_CLOSE_WRITE(self, event):
+        self.__watcher.queue(event.pathname, OP_SCAN, False)
+
+    def process_IN_CREATE(self, event):
+        # Files get scanned once written. Directories are scanned as a whole
+        # as files may be created in them before their watch is added
+        if event.dir:
+            self.__watcher.queue(event.pathname, OP_SCAN, True)
+
+    def process_IN_MOVED_TO(self, event):
+        self.__watcher.queue(event.pathname, OP_SCAN, event.dir)
+
+    def process_IN_DELETE(self, event):
+        self.__watcher.queue(event.pathname, OP_REMOVE, event.dir)
+
+    def process_IN_MOVED_FROM(self, event):
+        self.__watcher.queue(event.pathname, OP_REMOVE, event.dir)
+
+class SupysonicWatcher:
+    """Watches the root folders with inotify and applies the changes to the
+    database through the scanner.
+
+    Events are coalesced per path and applied in a single transaction once no
+    event came for wait_delay seconds, or after ten times that delay during a
+    continuous burst. Changes that failed to apply are tried once more with
+    the next ones."""
+
+    MASK = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+
+    def __init__(self):
+        self.__delay = float(config.get('daemon', 'wait_delay') or 5)
+        self.__pending = {}
+        self.__first_event = self.__last_event = None
+        self.__retried = set()
+
+        self.__roots = session.query(Folder).filter(Folder.root == True).all()
+        self.__scanner = Scanner(session)
+
+    def queue(self, path, op, is_dir):
+        self.__pending[path] = (op, is_dir)
+        self.__last_event = time.time()
+        if self.__first_event is None:
+            self.__first_event = self.__last_event
+
+    def run(self):
+        wm = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(wm, EventHandler(watcher = self), timeout = 500)
+        for folder in self.__roots:
+            app.logger.info('Watching %s', folder.path)
+            wm.add_watch(folder.path, self.MASK, rec = True, auto_add = True)
+
+        try:
+            while True:
+                notifier.process_events()
+                if notifier.check_events():
+                    notifier.read_events()
+
+                now = time.time()
+                if self.__pending and (now - self.__last_event >= self.__delay or now - self.__first_event >= self.__delay * 10):
+                    self.__process()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            notifier.stop()
+            if self.__pending:
+                self.__process()
+
+    def __process(self):
+        pending, self.__pending = self.__pending, {}
+        self.__first_event = self.__last_event = None
+
+        app.logger.info('Applying %i changes', len(pending))
+        try:
+            for path, (op, is_dir) in sorted(pending.iteritems()):
+                root = self.__find_root(path)
+                if root is None:
+                    continue
+
+                if op == OP_REMOVE:
+                    if is_dir:
+                        self.__scanner.remove_directory(path, root)
+                    else:
+                        self.__scanner.remove_file(path, root)
+                elif is_dir:
+                    for dirpath, dirnames, filenames in os.walk(path):
+                        for f in filenames:
+                            if self.__scanner.accepts(f):
+                                self.__scanner.scan_file(os.path.join(dirpath, f), root)
+                elif self.__scanner.accepts(path) and os.path.isfile(path):
+                    self.__scanner.scan_file(path, root)
+
+            self.__scanner.commit()
+            self.__retried = set()
+        except:
+            app.logger.error('Error while applying changes, rolling back')
+            app.logger.error(traceback.format_exc())
+            session.rollback()
+            # The scanner would still take the rolled back rows as stored, a new one loads what the database has
+            self.__scanner = Scanner(session)
+
+            retry = [ path for path in pending if path not in self.__retried ]
+            for path in retry:
+                if path not in self.__pending:
+                    self.queue(path, *pending[path])
+            self.__retried = set(retry)
+
+        added, deleted = self.__scanner.stats()
+        app.logger.info('Total added: %i artists, %i albums, %i tracks', *added)
+        app.logger.info('Total deleted: %i artists, %i albums, %i tracks', *deleted)
+
+    def __find_root(self, path):
+        for folder in self.__roots:
+            if path.startswith(folder.path.rstrip(os.sep) + os.sep):
+                return folder
+        return None